@@ -5,6 +5,8 @@ logging.getLogger("PIL").setLevel(logging.ERROR)
 logging.getLogger().setLevel(logging.WARNING)
 
 import subprocess
+import threading
+from functools import partial
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.image import Image
@@ -20,23 +22,25 @@ from kivy.graphics import StencilPush, StencilUse, StencilPop, StencilUnUse
 
 import numpy as np
 import cv2
-import base64
-import face_recognition
+import face_recognition_models
 import dlib
-import mysql.connector
-from mysql.connector import Error
-from datetime import datetime
+from datetime import datetime, timedelta
 from scipy.spatial import distance as dist
 import config
+from db import get_conn
+from gallery import FaceGallery, GallerySync, load_snapshot, update_snapshot
+from ivf_index import index_from_config
+from frame_grabber import FrameGrabber
+from motion_gate import MotionGate
+from status_cache import TodayStatus
+from migrations import migrate
+from punch_journal import PunchJournal
 
 # ---------------- Config ----------------
 b_dir = "/home/pi/face_attendance/"
 
 
 
-def get_conn():
-    return mysql.connector.connect(**config.DB_CONFIG)
-
 subprocess.run(["wlr-randr", "--output", "DSI-1", "--on"])
 
 Window.fullscreen = True
@@ -46,93 +50,39 @@ Window.clearcolor = (0.93, 0.95, 1, 1)
 
 
 # ---------------- Database Utilities ----------------
-def create_attendance_table():
+def refresh_gallery(gallery_sync):
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS attendance (
-            id INT PRIMARY KEY AUTO_INCREMENT,
-            emp_id INT NOT NULL,
-            name VARCHAR(255) NOT NULL,
-            status VARCHAR(20) NOT NULL,
-            timestamp DATETIME NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
-def get_face_data_from_db():
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT emp_id, name, designation, encodings FROM info")
-    rows = cursor.fetchall()
-    conn.close()
-
-    emp_ids, names, designations, encodings = [], [], [], []
-
-    for emp_id, name, desig, enc_b64 in rows:
-        try:
-            if not enc_b64:
-                continue
-
-            arr_bytes = base64.b64decode(enc_b64)
-            face_encoding = np.frombuffer(arr_bytes, dtype=np.float64)
-
-            if face_encoding.size != 128:
-                face_encoding = np.frombuffer(arr_bytes, dtype=np.float32)
-
-            if face_encoding.size == 128:
-                emp_ids.append(emp_id)
-                names.append(name)
-                designations.append(desig)
-                encodings.append(face_encoding)
-
-        except Exception as e:
-            print(f"[ERROR] Could not process {name}: {e}")
-
-    return emp_ids, names, designations, encodings
+    try:
+        changed = gallery_sync.refresh(conn)
+    finally:
+        conn.close()
 
+    try:
+        update_snapshot(gallery_sync, config.GALLERY_SNAPSHOT_PATH, changed)
+    except OSError as e:
+        print(f"[WARN] Could not write gallery snapshot: {e}")
+    return changed
 
-def get_latest_record(emp_id):
-    today = datetime.now().strftime("%Y-%m-%d")
-
-    conn = get_conn()
-    cursor = conn.cursor()
 
-    cursor.execute("""
-        SELECT id, emp_id, name, status, timestamp
-        FROM attendance
-        WHERE emp_id = %s
-          AND DATE(timestamp) = %s
-        ORDER BY id DESC
-        LIMIT 1
-    """, (emp_id, today))
-
-    record = cursor.fetchone()
-    conn.close()
-    return record
+# Punches are acknowledged once journalled; a flusher thread inserts them
+punch_journal = PunchJournal(config.PUNCH_JOURNAL_PATH, config.PUNCH_FLUSH_INTERVAL)
+# Today's last punch per employee, read by the worker and the punch button
+today_status = TodayStatus(punch_journal)
 
 
 def record_attendance(emp_id, name):
     now = datetime.now()
     timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    record = get_latest_record(emp_id)
-    last_status = record[3] if record else None
-
+    try:
+        last_status = today_status.status(emp_id)
+    except Exception as e:
+        print(f"[ERROR] Status lookup failed: {e}")
+        last_status = None
     new_status = "out" if last_status == "in" else "in"
 
-    conn = get_conn()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO attendance (emp_id, name, status, timestamp, device_id)
-        VALUES (%s, %s, %s, %s, %s)
-    """, (emp_id, name, new_status, timestamp, config.DEVICE_ID))
-
-    conn.commit()
-    conn.close()
+    punch_journal.append(emp_id, name, new_status, timestamp, config.DEVICE_ID)
+    today_status.record(emp_id, new_status)
 
     msg = f"Attendance Marked at {timestamp}"
     color = (0.8, 0, 0, 1) if new_status == "out" else (0, 0.8, 0, 1)
@@ -166,37 +116,165 @@ class CameraManager:
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
 
-    def get_frame(self):
+        # Capture runs on its own thread; the UI tick only picks up the newest frame
+        self.grabber = FrameGrabber(self.read_frame)
+        self.shown_seq = 0
+
+    def read_frame(self):
         if self.using_picam2:
             return self.picam2.capture_array()
         else:
             ret, frame = self.cap.read()
-            return frame if ret else np.zeros((240, 320, 3), dtype=np.uint8)
+            return frame if ret else None
+
+    def get_frame(self):
+        # Preview only: the newest frame, shared with the recognition worker
+        # (which takes its own via grabber.latest). None if nothing new yet.
+        seq, frame = self.grabber.peek()
+        if seq == self.shown_seq:
+            return None
+        self.shown_seq = seq
+        return frame
 
     def release(self):
+        self.grabber.stop()
         if self.using_picam2:
             self.picam2.stop()
         else:
             self.cap.release()
 
 
+# ---------------- Recognition Worker ----------------
+class RecognitionWorker(threading.Thread):
+    """
+    Detection, landmarks, encoding and the attendance lookup run here, off
+    the Kivy thread. Each processed frame is posted back to the UI with
+    Clock.schedule_once, so the preview never waits on inference or MySQL.
+    """
+    EYE_AR_THRESH = 0.22
+
+    def __init__(self, app):
+        super().__init__(name="recognition", daemon=True)
+        self.app = app
+        self.running = True
+        self.blinked = False
+        self.predictor = dlib.shape_predictor(b_dir+"shape_predictor_68_face_landmarks.dat")
+        self.face_encoder = dlib.face_recognition_model_v1(face_recognition_models.face_recognition_model_location())
+        self.detector = dlib.get_frontal_face_detector()
+        self.motion = MotionGate(config.MOTION_PIXEL_DELTA, config.MOTION_MIN_FRACTION, config.MOTION_HOLD_SECONDS)
+
+    def run(self):
+        while self.running:
+            frame = self.app.camera.grabber.latest(timeout=1.0)
+            if frame is None or frame.size == 0:
+                continue
+            try:
+                result = self.recognize(frame)
+            except Exception as e:
+                print(f"[ERROR] Recognition failed: {e}")
+                continue
+            Clock.schedule_once(partial(self.app.on_recognition, *result))
+
+    def stop(self):
+        self.running = False
+
+    def recognize(self, frame):
+        """Returns (recognized_name, emp_id, designation, status_fetched, last_status)"""
+        frame_small = cv2.resize(frame, (200, 200))
+
+        gray = cv2.cvtColor(frame_small, cv2.COLOR_BGR2GRAY)
+        # Idle: nobody on screen and nothing moving, skip detection entirely
+        moving = self.motion.update(gray)
+        if config.ENABLE_MOTION_GATE and not moving and self.app.current_emp is None:
+            return None, None, None, False, None
+        rgb = cv2.cvtColor(frame_small, cv2.COLOR_BGR2RGB)
+
+        rects = self.detector(gray, 0)
+        recognized_name, emp_id, designation = None, None, None
+
+        for rect in rects:
+            # One landmark pass per face, shared by the blink check and the
+            # descriptor; the gallery is enrolled on the same 68-point model
+            shape = self.predictor(rgb, rect)
+            shape_np = np.array([[shape.part(i).x, shape.part(i).y] for i in range(68)])
+            leftEye, rightEye = shape_np[42:48], shape_np[36:42]
+
+            ear = (eye_aspect_ratio(leftEye) + eye_aspect_ratio(rightEye)) / 2.0
+
+            if ear < self.EYE_AR_THRESH and not self.blinked:
+                self.blinked = True
+            elif ear >= self.EYE_AR_THRESH:
+                self.blinked = False
+
+            if not self.blinked:
+                continue
+
+            face_encoding = np.array(self.face_encoder.compute_face_descriptor(rgb, shape, 1))
+            gallery = self.app.gallery
+            if len(gallery):
+                best_id, best_name, best_desig, distance = gallery.best_two(face_encoding, config.IDENTITY_AGGREGATION)[0]
+                if distance < 0.40:
+                    recognized_name = best_name
+                    emp_id = best_id
+                    designation = best_desig
+                else:
+                    recognized_name = "Unknown"
+            self.blinked = False
+
+        # Only look up today's punches when the person on screen changes
+        status_fetched, last_status = False, None
+        current_emp = self.app.current_emp
+        if emp_id is not None and (current_emp is None or current_emp[0] != emp_id):
+            last_status = today_status.status(emp_id)
+            status_fetched = True
+
+        return recognized_name, emp_id, designation, status_fetched, last_status
+
+
 # ---------------- Main App ----------------
 class DetectApp(App):
     VERIFIED_DISPLAY_TIME = 5
 
     def build(self):
-        create_attendance_table()
-        self.emp_ids, self.names, self.designations, self.encodings = get_face_data_from_db()
-        print(f"[INFO] Loaded {len(self.emp_ids)} employees from database.")
+        # The kiosk must come up even while MariaDB is down: punches go to the
+        # journal, statuses come from it, and the background catch-up and
+        # gallery refresh recover once the database is back
+        try:
+            migrate()
+        except Exception as e:
+            print(f"[ERROR] Schema migration failed: {e}")
+        punch_journal.start()
+        try:
+            today_status.warm()
+        except Exception as e:
+            print(f"[ERROR] Attendance status warm-up failed: {e}")
+        threading.Thread(
+            target=today_status.run_catch_up, args=(config.STATUS_CATCHUP_INTERVAL,), daemon=True
+        ).start()
+        self.gallery_sync = load_snapshot(
+            config.GALLERY_SNAPSHOT_PATH, timedelta(hours=config.GALLERY_SNAPSHOT_MAX_AGE_HOURS),
+            index=index_from_config()
+        )
+        if self.gallery_sync:
+            print(f"[INFO] Loaded {len(self.gallery_sync.gallery)} employees from snapshot.")
+            # Catch up with the database once the preview is already running
+            Clock.schedule_once(self.refresh_face_data, 5)
+        else:
+            self.gallery_sync = GallerySync(FaceGallery(index=index_from_config()))
+            try:
+                refresh_gallery(self.gallery_sync)
+                print(f"[INFO] Loaded {len(self.gallery_sync.gallery)} employees from database.")
+            except Exception as e:
+                print(f"[ERROR] Failed to load face data, retrying in the background: {e}")
+                Clock.schedule_once(self.refresh_face_data, 5)
+        self.gallery = self.gallery_sync.gallery
 
         self.camera = CameraManager()
-        self.predictor = dlib.shape_predictor(b_dir+"shape_predictor_68_face_landmarks.dat")
-        self.detector = dlib.get_frontal_face_detector()
+        self.worker = RecognitionWorker(self)
 
-        self.EYE_AR_THRESH = 0.22
-        self.blinked = False
         self.current_emp = None
         self.last_detect_time = None
+        self.punch_pending = False
 
         layout = BoxLayout(orientation='vertical', padding=3, spacing=1)
 
@@ -281,6 +359,7 @@ class DetectApp(App):
             allow_stretch=True,
             keep_ratio=False  # full fit inside clipped region
         )
+        self.preview_texture = None
 
         self.preview_container.add_widget(self.img_widget)
 
@@ -343,19 +422,21 @@ class DetectApp(App):
         layout.add_widget(self.action_button)
 
         # schedule frame updates and periodic face-data refresh
-        Clock.schedule_interval(self.update_frame, 1/15)
+        # The UI tick only blits frames; recognition runs on the worker thread
+        Clock.schedule_interval(self.update_frame, 1/30)
         Clock.schedule_interval(self.refresh_face_data, 300)  # every 5 minutes
+        self.worker.start()
 
         return layout
 
     def refresh_face_data(self, dt):
+        threading.Thread(target=self._refresh_face_data, daemon=True).start()
+
+    def _refresh_face_data(self):
         try:
-            new_emp_ids, new_names, new_designations, new_encodings = get_face_data_from_db()
-            self.emp_ids = new_emp_ids
-            self.names = new_names
-            self.designations = new_designations
-            self.encodings = new_encodings
-            print(f"[INFO] Refreshed face data: {len(self.emp_ids)} employees loaded.")
+            # Only rows created/updated/deleted since the last refresh are touched
+            changed = refresh_gallery(self.gallery_sync)
+            print(f"[INFO] Refreshed face data: {changed} changed, {len(self.gallery)} employees loaded.")
         except Exception as e:
             print(f"[ERROR] Failed to refresh face data: {e}")
 
@@ -384,62 +465,30 @@ class DetectApp(App):
         if frame is None or frame.size == 0:
             return
 
-        frame_small = cv2.resize(frame, (200, 200))
-        frame_display = cv2.resize(frame_small, (400, 400))
-
-        gray = cv2.cvtColor(frame_small, cv2.COLOR_BGR2GRAY)
-        rgb = cv2.cvtColor(frame_small, cv2.COLOR_BGR2RGB)
-        
         # ---------- Display frame ----------
-        frame_display = cv2.resize(frame, (800, 860))
-
-        # ---------- Use full frame for recognition ----------
-        # gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-
-        rects = self.detector(gray, 0)
-        recognized_name, emp_id = None, None
+        # Texture is allocated once and updated in place. Scaling is left to the
+        # Image widget, the mirror/upright flip to texture coords, BGR to colorfmt.
+        h, w = frame.shape[:2]
+        if self.preview_texture is None or self.preview_texture.size != (w, h):
+            self.preview_texture = Texture.create(size=(w, h), colorfmt='bgr')
+            self.preview_texture.flip_vertical()
+            self.preview_texture.flip_horizontal()
+            self.img_widget.texture = self.preview_texture
+
+        self.preview_texture.blit_buffer(np.ascontiguousarray(frame).reshape(-1), colorfmt='bgr', bufferfmt='ubyte')
+        self.img_widget.canvas.ask_update()
+
+    def on_recognition(self, recognized_name, emp_id, designation, status_fetched, last_status, dt):
         DETECTION_TIMEOUT = 3
-
-        for rect in rects:
-            x, y, w, h = rect.left(), rect.top(), rect.width(), rect.height()
-            shape = self.predictor(rgb, rect)
-            shape_np = np.array([[shape.part(i).x, shape.part(i).y] for i in range(68)])
-            leftEye, rightEye = shape_np[42:48], shape_np[36:42]
-
-            ear = (eye_aspect_ratio(leftEye) + eye_aspect_ratio(rightEye)) / 2.0
-
-            if ear < self.EYE_AR_THRESH and not self.blinked:
-                self.blinked = True
-            elif ear >= self.EYE_AR_THRESH:
-                self.blinked = False
-
-            if not self.blinked:
-                continue
-
-            face_locations = [(y, x + w, y + h, x)]
-            encodings = face_recognition.face_encodings(rgb, face_locations)
-
-            if encodings:
-                face_encoding = encodings[0]
-                if self.encodings:
-                    distances = np.linalg.norm(np.array(self.encodings) - face_encoding, axis=1)
-                    idx = np.argmin(distances)
-                    if distances[idx] < 0.40:
-                        recognized_name = self.names[idx]
-                        emp_id = self.emp_ids[idx]
-                    else:
-                        recognized_name = "Unknown"
-                self.blinked = False
-
         now = datetime.now()
 
         if recognized_name is not None:
             self.last_detect_time = now
             if recognized_name != "Unknown":
                 if self.current_emp is None or self.current_emp[0] != emp_id:
-                    self.show_person_info(emp_id, recognized_name)
+                    # If the worker skipped the lookup, the next frame brings it
+                    if status_fetched:
+                        self.show_person_info(emp_id, recognized_name, designation, last_status)
             else:
                 self.current_emp = None
                 for k in self.info_labels:
@@ -450,24 +499,16 @@ class DetectApp(App):
             if self.last_detect_time and (now - self.last_detect_time).total_seconds() > DETECTION_TIMEOUT:
                 self.reset_view()
 
-        frame_display = cv2.cvtColor(frame_display, cv2.COLOR_BGR2RGB)
-        buf = cv2.flip(frame_display, -1).tobytes()
-        texture = Texture.create(size=(frame_display.shape[1], frame_display.shape[0]), colorfmt='rgb')
-        texture.blit_buffer(buf, colorfmt='rgb', bufferfmt='ubyte')
-        self.img_widget.texture = texture
-
-    def show_person_info(self, emp_id, name):
-        record = get_latest_record(emp_id)
+    def show_person_info(self, emp_id, name, designation, last_status):
         self.current_emp = (emp_id, name)
-        idx = self.emp_ids.index(emp_id)
         # self.info_labels["ID"].text = str(emp_id)
         # self.info_labels["ID"].color = ((0.0, 0.2, 0.6, 1))
         self.info_labels["Name"].text = name
         self.info_labels["Name"].color = ((0.0, 0.2, 0.6, 1))
-        self.info_labels["Designation"].text = self.designations[idx]
+        self.info_labels["Designation"].text = designation
         self.info_labels["Designation"].color = ((0.0, 0.2, 0.6, 1))
 
-        if record and record[3] == "in":
+        if last_status == "in":
             self.action_button.text = "Punch Out"
             self.action_button.background_color = (0.8, 0, 0, 1)
             self.action_button.punch_type = "out"
@@ -479,13 +520,23 @@ class DetectApp(App):
         self.action_button.opacity = 1
 
     def handle_punch(self, instance):
-        if not self.current_emp:
+        if not self.current_emp or self.punch_pending:
             return
         emp_id, name = self.current_emp
-        msg, color, new_status = record_attendance(emp_id, name)
-        self.show_verified_screen(msg, color)
+        self.punch_pending = True
+        self.action_button.opacity = 0
+        threading.Thread(target=self._punch, args=(emp_id, name), daemon=True).start()
+
+    def _punch(self, emp_id, name):
+        try:
+            msg, color, new_status = record_attendance(emp_id, name)
+        except Exception as e:
+            print(f"[ERROR] Failed to record attendance: {e}")
+            msg, color = f"Error: {e}", (1, 0, 0, 1)
+        Clock.schedule_once(lambda dt: self.show_verified_screen(msg, color))
 
     def show_verified_screen(self, msg, color):
+        self.punch_pending = False
         self.info_card.clear_widgets()
         self.action_button.opacity = 0
 
@@ -516,6 +567,8 @@ class DetectApp(App):
         self.info_card.add_widget(self.info_grid)
 
     def on_stop(self):
+        self.worker.stop()
+        self.worker.join(timeout=2.0)
         self.camera.release()
 
 
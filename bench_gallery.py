@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#!/home/pi/acs/acsenv/bin/python
+"""
+Recall / latency of the IVF gallery index against brute force on synthetic
+galleries. Usage:  python bench_gallery.py [size ...]   (default 10k 30k 100k)
+"""
+import sys
+import time
+import numpy as np
+import config
+from gallery import FaceGallery, EMBEDDING_DIM
+from ivf_index import IVFIndex
+
+PHOTOS_PER_EMPLOYEE = 3
+PROBES = 300
+
+# Spreads chosen so synthetic distances look like dlib's:
+# ~0.9 between different people, ~0.35 between photos of the same person.
+IDENTITY_SPREAD = 0.9 / np.sqrt(2 * EMBEDDING_DIM)
+PHOTO_SPREAD = 0.35 / np.sqrt(2 * EMBEDDING_DIM)
+
+
+def build(index, photos):
+    gallery = FaceGallery(capacity=len(photos), index=index)
+    for row_id in range(len(photos)):
+        emp_id = row_id // PHOTOS_PER_EMPLOYEE
+        gallery.upsert(row_id, emp_id, str(emp_id), "", photos[row_id])
+    gallery.train_index()
+    return gallery
+
+
+def timed_matches(gallery, probes):
+    results = []
+    start = time.perf_counter()
+    for probe in probes:
+        results.append(gallery.best_two(probe, config.IDENTITY_AGGREGATION))
+    elapsed = (time.perf_counter() - start) / len(probes)
+    return results, elapsed * 1000
+
+
+def decision(matches):
+    emp_id, _, _, best = matches[0]
+    if best > config.CUSTOM_THRESHOLDS.get(emp_id, config.FACE_MATCH_THRESHOLD):
+        return None
+    if len(matches) > 1 and matches[1][3] - best < config.CONFIDENCE_GAP:
+        return None
+    return emp_id
+
+
+def run(size, nprobe_values):
+    rng = np.random.default_rng(size)
+    employees = size // PHOTOS_PER_EMPLOYEE
+    centers = rng.normal(0, IDENTITY_SPREAD, (employees, EMBEDDING_DIM)).astype(np.float32)
+    photos = np.repeat(centers, PHOTOS_PER_EMPLOYEE, axis=0)
+    photos += rng.normal(0, PHOTO_SPREAD, photos.shape).astype(np.float32)
+
+    who = rng.integers(0, employees, PROBES)
+    probes = centers[who] + rng.normal(0, PHOTO_SPREAD, (PROBES, EMBEDDING_DIM)).astype(np.float32)
+
+    brute = build(None, photos)
+    exact, brute_ms = timed_matches(brute, probes)
+    print(f"\n{len(photos)} photos / {employees} employees")
+    print(f"  brute        {brute_ms:7.2f} ms/probe")
+
+    for nprobe in nprobe_values:
+        start = time.perf_counter()
+        ivf = build(IVFIndex(nprobe=nprobe, min_size=0), photos)
+        build_s = time.perf_counter() - start
+        approx, ivf_ms = timed_matches(ivf, probes)
+
+        top1 = np.mean([a[0][0] == e[0][0] for a, e in zip(approx, exact)])
+        # Same accept/reject outcome under FACE_MATCH_THRESHOLD and CONFIDENCE_GAP
+        same = np.mean([decision(a) == decision(e) for a, e in zip(approx, exact)])
+        print(f"  ivf nprobe={nprobe:<3} {ivf_ms:7.2f} ms/probe  "
+              f"x{brute_ms / ivf_ms:4.1f}  recall@1 {top1:.3f}  same decision {same:.3f}  "
+              f"(build {build_s:.1f}s, {len(ivf.index.centroids)} lists)")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 30_000, 100_000]
+    for size in sizes:
+        run(size, (4, 8, 16, 32))
+
+
+if __name__ == "__main__":
+    main()
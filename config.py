@@ -10,6 +10,13 @@ DB_CONFIG = {
     "database": "face_attendance"
 }
 
+# Connections kept open per process (kiosk threads + sync scripts share db.py)
+DB_POOL_SIZE = 4
+
+# How often (seconds) kiosks pick up attendance rows written by other
+# processes (sync_foreign_data.py) into their in-memory punch status
+STATUS_CATCHUP_INTERVAL = 60
+
 # ==========================================
 # 2. SYSTEM PATHS & DEVICE
 # ==========================================
@@ -17,6 +24,28 @@ DB_CONFIG = {
 BASE_DIR = '/home/pi/face_attendance/' 
 DLIB_PREDICTOR_PATH = BASE_DIR + 'shape_predictor_68_face_landmarks.dat'
 
+# Memory-mapped gallery snapshot (<path>.json + the <path>.*.npy it names) written by
+# generate_embeddings.py so kiosks can start matching without the database.
+GALLERY_SNAPSHOT_PATH = BASE_DIR + 'gallery_snapshot'
+# Snapshots not confirmed against the database for this long (kiosks confirm
+# them on every refresh) are ignored and the gallery is loaded from the database
+GALLERY_SNAPSHOT_MAX_AGE_HOURS = 24
+
+# Local SQLite journal punches are written to before they reach MariaDB
+PUNCH_JOURNAL_PATH = BASE_DIR + 'punch_journal.db'
+# Seconds between flush retries while the database is unreachable
+PUNCH_FLUSH_INTERVAL = 5.0
+
+# generate_embeddings.py: worker processes (None = one per CPU core) and
+# photos queued per worker, which bounds memory during bulk imports
+EMBEDDING_WORKERS = None
+EMBEDDING_QUEUE_PER_WORKER = 2
+
+# sync_emp_data.py: employees written and committed per chunk. Up to ten
+# photos each, so this bounds both memory and the size of one INSERT
+# (keep it well under the server's max_allowed_packet).
+SYNC_CHUNK_SIZE = 10
+
 # Unique ID for this specific Attendance Machine
 DEVICE_ID = 71
 
@@ -30,8 +59,21 @@ CAM_RES = (640, 480)
 # Target Framerate
 FPS = 30
 
+# /video_feed (f_app.py): adapt the MJPEG stream to processing load and to
+# how fast clients take frames. Ladder of (scale, JPEG quality), best first;
+# the stream steps down while a frame overruns 1/FPS.
+STREAM_ADAPTIVE = True
+STREAM_LADDER = [(1.0, 80), (1.0, 70), (1.0, 60), (0.75, 60), (0.75, 50), (0.5, 50)]
+
+# Web kiosk server: "flask" (Werkzeug, one thread per connection) or
+# "asgi" (f_asgi.py: Starlette + uvicorn, one event loop; pip install
+# starlette uvicorn)
+WEB_SERVER = "flask"
+
 # Image scaling for processing (Lower = Faster, Higher = More Accurate)
 # 1.0 = Full resolution. 0.5 = Half size (4x faster).
+# On Picamera2 this sizes the camera's second (low-res) stream, so the
+# scaling costs no CPU; CAM_RES is then only used for the web preview.
 PROCESS_SCALE = 1.0
 
 # ==========================================
@@ -52,6 +94,20 @@ CUSTOM_THRESHOLDS = {
 # Prevents confusion between similar looking people.
 CONFIDENCE_GAP = 0.04
 
+# MULTIPLE PHOTOS: How an employee's photos are combined into one score.
+# "min" = closest photo wins, "mean" = average over all their photos.
+# The Confidence Gap is always checked between two different employees.
+IDENTITY_AGGREGATION = "min"
+
+# LARGE GALLERIES: "brute" checks every photo on every match.
+# "ivf" groups photos into clusters and only checks the IVF_NPROBE clusters
+# nearest to the face (then re-checks those exactly, so the thresholds above
+# still apply). Only used once the gallery has IVF_MIN_SIZE photos.
+# Run bench_gallery.py to see the speed/recall trade-off for your headcount.
+GALLERY_INDEX = "brute"
+IVF_NPROBE = 8
+IVF_MIN_SIZE = 5000
+
 # ==========================================
 # 5. DETECTION & STABILITY
 # ==========================================
@@ -72,6 +128,26 @@ REQUIRED_STREAK = 3
 # PERSISTENCE: How many frames to keep the box if face is momentarily lost.
 MAX_MISSED_FRAMES = 2
 
+# TRACKING: Follow the face with optical flow between detections (f_app.py).
+# While tracking holds, MediaPipe only re-runs every TRACK_REDETECT_FRAMES
+# frames; it runs immediately when the tracker loses the face.
+ENABLE_TRACKER = True
+TRACK_REDETECT_FRAMES = 10
+
+# IDLE: With nobody on screen, the detector only runs while something moves.
+# Motion = more than MOTION_MIN_FRACTION of pixels (on a 32x24 thumbnail)
+# changing by more than MOTION_PIXEL_DELTA grey levels between frames.
+# Detection keeps running for MOTION_HOLD_SECONDS after the last motion.
+ENABLE_MOTION_GATE = True
+MOTION_PIXEL_DELTA = 15
+MOTION_MIN_FRACTION = 0.01
+MOTION_HOLD_SECONDS = 3.0
+
+# ROI: While a recognised user is verifying / ready, MediaPipe only searches
+# their last box grown by this fraction of its size on every side; the
+# full frame is searched only if the face is not found there.
+ROI_MARGIN = 0.5
+
 # ==========================================
 # 6. LIVENESS (HEAD TURN)
 # ==========================================
@@ -101,3 +177,6 @@ RESET_TIME_AFTER_PUNCH = 2.0
 
 # How long (seconds) the Punch Button stays visible if user does nothing
 BUTTON_TIMEOUT = 5.0
+
+# Seconds between keep-alive comments on an idle /status/stream connection
+STATUS_KEEPALIVE = 15
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import threading
+import mysql.connector
+from mysql.connector import errors, pooling
+import config
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Created on first use, so a DB that is down at boot is retried on the next call
+            _pool = pooling.MySQLConnectionPool(
+                pool_name="face_attendance",
+                pool_size=config.DB_POOL_SIZE,
+                **config.DB_CONFIG
+            )
+        return _pool
+
+
+def get_conn():
+    """
+    A pooled connection; close() hands it back instead of disconnecting.
+    The pool pings connections on checkout and reconnects dead ones
+    (MariaDB restart, wait_timeout). If every pooled connection is busy a
+    one-off connection is opened instead of failing.
+    """
+    try:
+        return get_pool().get_connection()
+    except errors.PoolError:
+        return mysql.connector.connect(**config.DB_CONFIG)
+
+
+def _run(sql, params, fetch):
+    conn = get_conn()
+    try:
+        # Plain cursor: one round trip per statement. A server-side prepared
+        # statement would not outlive the call, because the pool resets the
+        # session (deallocating statements) when the connection goes back.
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        if fetch == "one":
+            # fetchall drains the result so the connection goes back to the pool clean
+            rows = cursor.fetchall()
+            result = rows[0] if rows else None
+        else:
+            result = cursor.fetchall()
+        cursor.close()
+        return result
+    finally:
+        conn.close()
+
+
+def fetchone(sql, params=()):
+    return _run(sql, params, "one")
+
+
+def fetchall(sql, params=()):
+    return _run(sql, params, "all")
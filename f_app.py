@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 import logging
+import json
 import cv2
 import time
 import threading
 import numpy as np
-import base64
-import face_recognition
+import face_recognition_models
 import dlib
-import mysql.connector
 from scipy.spatial import distance as dist
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import Flask, render_template, Response, jsonify, request
 import mediapipe as mp
 import config 
+import db
+from gallery import FaceGallery, GallerySync, load_snapshot, update_snapshot
+from ivf_index import index_from_config
+from frame_grabber import FrameGrabber
+from face_tracker import FlowTracker
+from motion_gate import MotionGate
+from status_cache import TodayStatus
+from migrations import migrate
+from punch_journal import PunchJournal
 
 # --- LOGGING SETUP ----
 logging.basicConfig(level=logging.WARNING)
@@ -26,74 +34,50 @@ app = Flask(__name__)
 # 1. DATABASE MANAGER
 # ==========================================
 class DatabaseManager:
+    # Punches are acknowledged once journalled; a flusher thread inserts them
+    punch_journal = PunchJournal(config.PUNCH_JOURNAL_PATH, config.PUNCH_FLUSH_INTERVAL)
+    # Today's last punch per employee; the button is chosen from memory
+    today_status = TodayStatus(punch_journal)
+
     @staticmethod
     def get_connection():
-        return mysql.connector.connect(**config.DB_CONFIG)
+        # Pooled: close() returns the connection to the shared pool (see db.py)
+        return db.get_conn()
 
     @staticmethod
     def setup_tables():
         try:
-            conn = DatabaseManager.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS attendance (
-                    id INT PRIMARY KEY AUTO_INCREMENT,
-                    emp_id INT NOT NULL,
-                    name VARCHAR(255) NOT NULL,
-                    status VARCHAR(20) NOT NULL,
-                    timestamp DATETIME NOT NULL,
-                    device_id VARCHAR(50)
-                )
-            """)
-            conn.commit()
-            conn.close()
+            migrate()
         except Exception as e:
             print(f"[DB ERROR] Setup failed: {e}")
 
     @staticmethod
-    def fetch_users():
-        emp_ids, names, designations, encodings = [], [], [], []
+    def refresh_gallery(gallery_sync):
         try:
             conn = DatabaseManager.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT emp_id, name, designation, encodings FROM info")
-            rows = cursor.fetchall()
+            changed = gallery_sync.refresh(conn)
             conn.close()
-
-            for emp_id, name, desig, enc_b64 in rows:
-                if enc_b64:
-                    try:
-                        arr_bytes = base64.b64decode(enc_b64)
-                        face_encoding = np.frombuffer(arr_bytes, dtype=np.float64)
-                        if face_encoding.size != 128:
-                            face_encoding = np.frombuffer(arr_bytes, dtype=np.float32)
-                        
-                        if face_encoding.size == 128:
-                            emp_ids.append(emp_id)
-                            names.append(name)
-                            designations.append(desig)
-                            encodings.append(face_encoding)
-                    except:
-                        pass
-            print(f"[DB INFO] Loaded {len(emp_ids)} users.")
+            print(f"[DB INFO] Loaded {len(gallery_sync.gallery)} users ({changed} changed).")
+            update_snapshot(gallery_sync, config.GALLERY_SNAPSHOT_PATH, changed)
         except Exception as e:
             print(f"[DB ERROR] Fetch users failed: {e}")
-        return emp_ids, names, designations, encodings
+
+    @staticmethod
+    def warm_status():
+        try:
+            count = DatabaseManager.today_status.warm()
+            print(f"[DB INFO] {count} employees have punched today.")
+        except Exception as e:
+            print(f"[DB ERROR] Status warm-up failed: {e}")
+        threading.Thread(
+            target=DatabaseManager.today_status.run_catch_up,
+            args=(config.STATUS_CATCHUP_INTERVAL,), daemon=True
+        ).start()
 
     @staticmethod
     def get_last_status(emp_id):
         try:
-            conn = DatabaseManager.get_connection()
-            cursor = conn.cursor()
-            today = datetime.now().strftime("%Y-%m-%d")
-            cursor.execute("""
-                SELECT status FROM attendance 
-                WHERE emp_id = %s AND DATE(timestamp) = %s 
-                ORDER BY id DESC LIMIT 1
-            """, (emp_id, today))
-            record = cursor.fetchone()
-            conn.close()
-            return record[0] if record else "out"
+            return DatabaseManager.today_status.status(emp_id) or "out"
         except:
             return "out"
 
@@ -104,14 +88,8 @@ class DatabaseManager:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         try:
-            conn = DatabaseManager.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO attendance (emp_id, name, status, timestamp, device_id)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (emp_id, name, new_status, timestamp, config.DEVICE_ID))
-            conn.commit()
-            conn.close()
+            DatabaseManager.punch_journal.append(emp_id, name, new_status, timestamp, config.DEVICE_ID)
+            DatabaseManager.today_status.record(emp_id, new_status)
             
             color = "#cc0000" if new_status == "out" else "#00cc00"
             msg = f"MARKED {new_status.upper()}"
@@ -125,11 +103,24 @@ class DatabaseManager:
 class FaceSystem:
     def __init__(self):
         self.predictor = dlib.shape_predictor(config.DLIB_PREDICTOR_PATH)
-        self.emp_ids, self.names, self.designations, self.encodings = [], [], [], []
-        self.reload_data()
+        self.face_encoder = dlib.face_recognition_model_v1(face_recognition_models.face_recognition_model_location())
+        self.gallery_sync = load_snapshot(
+            config.GALLERY_SNAPSHOT_PATH, timedelta(hours=config.GALLERY_SNAPSHOT_MAX_AGE_HOURS),
+            index=index_from_config()
+        )
+        if self.gallery_sync:
+            print(f"[DB INFO] Loaded {len(self.gallery_sync.gallery)} users from snapshot.")
+            self.gallery = self.gallery_sync.gallery
+            # Matching starts from the snapshot; the database catch-up runs beside it
+            threading.Thread(target=self.reload_data, daemon=True).start()
+        else:
+            self.gallery_sync = GallerySync(FaceGallery(index=index_from_config()))
+            self.gallery = self.gallery_sync.gallery
+            self.reload_data()
 
     def reload_data(self):
-        self.emp_ids, self.names, self.designations, self.encodings = DatabaseManager.fetch_users()
+        # Delta refresh: only rows changed since the last load are decoded
+        DatabaseManager.refresh_gallery(self.gallery_sync)
 
     def get_head_pose_ratio(self, shape):
         nose = shape.part(30)
@@ -143,23 +134,21 @@ class FaceSystem:
         return dist_left / dist_right
 
     def recognize_from_box(self, rgb_frame, box):
-        if not self.encodings:
+        gallery = self.gallery
+        if len(gallery) == 0:
             return {'name': 'Unknown', 'id': None, 'desig': ''}
 
-        encodings = face_recognition.face_encodings(rgb_frame, known_face_locations=[box])
-        if not encodings:
-            return {'name': 'Unknown', 'id': None, 'desig': ''}
+        # Aligned on the 68-point model, like the enrolled gallery
+        # (face_encodings(..., model="large") in generate_embeddings.py)
+        t, r, b, l = box
+        shape = self.predictor(rgb_frame, dlib.rectangle(l, t, r, b))
+        current_encoding = np.array(self.face_encoder.compute_face_descriptor(rgb_frame, shape, 1))
 
-        current_encoding = encodings[0]
-        face_distances = face_recognition.face_distance(self.encodings, current_encoding)
-        
-        # Sort best to worst
-        sorted_indices = np.argsort(face_distances)
-        best_match_index = sorted_indices[0]
-        best_match_score = face_distances[best_match_index]
+        # Best and 2nd best distinct employees (argpartition, no full sort)
+        matches = gallery.best_two(current_encoding, config.IDENTITY_AGGREGATION)
         
         # Identify the potential candidate
-        candidate_emp_id = self.emp_ids[best_match_index]
+        candidate_emp_id, candidate_name, candidate_desig, best_match_score = matches[0]
         
         # --- [NEW] DETERMINE THRESHOLD ---
         # Check if this specific user has a custom threshold in config
@@ -174,9 +163,8 @@ class FaceSystem:
             return {'name': 'Unknown', 'id': None, 'desig': ''}
 
         # --- RULE 2: CONFIDENCE GAP ---
-        if len(self.encodings) > 1:
-            second_best_index = sorted_indices[1]
-            second_best_score = face_distances[second_best_index]
+        if len(matches) > 1:
+            second_best_score = matches[1][3]
             
             gap = second_best_score - best_match_score
             if gap < config.CONFIDENCE_GAP:
@@ -185,8 +173,8 @@ class FaceSystem:
 
         return {
             'id': candidate_emp_id,
-            'name': self.names[best_match_index],
-            'desig': self.designations[best_match_index],
+            'name': candidate_name,
+            'desig': candidate_desig,
             'encoding': current_encoding,
             'score': best_match_score
         }
@@ -195,31 +183,76 @@ class FaceSystem:
 # 3. CAMERA MANAGER
 # ==========================================
 class CameraManager:
+    """
+    Delivers (display_frame, detect_rgb, detect_gray) tuples.
+
+    On Picamera2 the ISP produces both: the main stream (CAM_RES) is only
+    used for the MJPEG preview, a low-res YUV420 stream (CAM_RES * PROCESS_SCALE)
+    feeds detection/recognition, and the mirror flip is done by the sensor
+    transform. Boxes move between the two with to_display()/to_detect().
+    """
     def __init__(self):
         self.cap = None
         self.using_picam = False
+        self.scale_x = self.scale_y = 1.0 / config.PROCESS_SCALE
         try:
             from picamera2 import Picamera2
+            from libcamera import Transform
             self.picam2 = Picamera2()
-            config_cam = self.picam2.create_preview_configuration(main={"size": config.CAM_RES, "format": "BGR888"})
+            lores_size = (int(config.CAM_RES[0] * config.PROCESS_SCALE) // 2 * 2,
+                          int(config.CAM_RES[1] * config.PROCESS_SCALE) // 2 * 2)
+            config_cam = self.picam2.create_preview_configuration(
+                main={"size": config.CAM_RES, "format": "BGR888"},
+                lores={"size": lores_size, "format": "YUV420"},
+                transform=Transform(hflip=1)
+            )
+            # Let libcamera pick stride-friendly sizes, then read back what we got
+            self.picam2.align_configuration(config_cam)
             self.picam2.configure(config_cam)
+            self.main_size = config_cam["main"]["size"]
+            self.lores_size = config_cam["lores"]["size"]
+            self.scale_x = self.main_size[0] / self.lores_size[0]
+            self.scale_y = self.main_size[1] / self.lores_size[1]
             self.picam2.start()
             self.using_picam = True
-            print("[CAM] Picamera2 initialized (BGR).")
+            print(f"[CAM] Picamera2 initialized (main {self.main_size}, lores {self.lores_size}).")
         except Exception:
             print("[CAM] Fallback to OpenCV.")
             self.cap = cv2.VideoCapture(0)
             self.cap.set(3, config.CAM_RES[0])
             self.cap.set(4, config.CAM_RES[1])
 
-    def get_frame(self):
+        # Sensor latency overlaps with processing: capture keeps the newest frame ready
+        self.grabber = FrameGrabber(self.read_frame)
+
+    def read_frame(self):
         if self.using_picam:
-            return self.picam2.capture_array()
+            (frame, yuv), _ = self.picam2.capture_arrays(["main", "lores"])
+            lores_h = self.lores_size[1]
+            # Y plane is the grayscale image for free
+            return frame, cv2.cvtColor(yuv, cv2.COLOR_YUV2RGB_I420), yuv[:lores_h]
         else:
             ret, frame = self.cap.read()
-            return frame if ret else None
+            if not ret:
+                return None
+            frame = cv2.flip(frame, 1)
+            small_frame = cv2.resize(frame, (0, 0), fx=config.PROCESS_SCALE, fy=config.PROCESS_SCALE)
+            return (frame, cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB),
+                    cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY))
+
+    def get_frame(self):
+        return self.grabber.latest()
+
+    def to_display(self, box):
+        t, r, b, l = box
+        return (int(t * self.scale_y), int(r * self.scale_x), int(b * self.scale_y), int(l * self.scale_x))
+
+    def to_detect(self, box):
+        t, r, b, l = box
+        return (int(t / self.scale_y), int(r / self.scale_x), int(b / self.scale_y), int(l / self.scale_x))
 
     def release(self):
+        self.grabber.stop()
         if self.using_picam:
             self.picam2.stop()
         elif self.cap:
@@ -236,6 +269,8 @@ class AttendanceSystem:
 
     def __init__(self):
         DatabaseManager.setup_tables()
+        DatabaseManager.punch_journal.start()
+        DatabaseManager.warm_status()
         self.face_system = FaceSystem()
         self.camera = CameraManager()
         
@@ -259,6 +294,8 @@ class AttendanceSystem:
         
         self.last_box_coords = None
         self.last_landmarks = None
+        self.tracker = FlowTracker()
+        self.motion = MotionGate(config.MOTION_PIXEL_DELTA, config.MOTION_MIN_FRACTION, config.MOTION_HOLD_SECONDS)
         
         self.button_timeout_timer = None
         self.reset_timer = None
@@ -267,6 +304,33 @@ class AttendanceSystem:
             "name": "", "subtext": "", "name_color": "#333333",
             "show_button": False, "button_text": "", "button_color": "#888888"
         }
+        # Bumped on every real change; /status/stream pushes on it
+        self.status_version = 1
+        self.status_cond = threading.Condition()
+        # Called (under status_cond) after each change (async server hook)
+        self.status_listeners = []
+
+    def set_status(self, changes):
+        with self.status_cond:
+            if all(self.ui_status.get(k) == v for k, v in changes.items()):
+                return
+            self.ui_status.update(changes)
+            self.status_version += 1
+            self.status_cond.notify_all()
+            for listener in self.status_listeners:
+                listener()
+
+    def get_status(self):
+        """(copy of ui_status, version)"""
+        with self.status_cond:
+            return dict(self.ui_status), self.status_version
+
+    def wait_status(self, since, timeout):
+        """Like get_status, once the version differs from since; None on timeout"""
+        with self.status_cond:
+            if not self.status_cond.wait_for(lambda: self.status_version != since, timeout):
+                return None
+            return dict(self.ui_status), self.status_version
 
     def reset_to_scanning(self):
         if self.button_timeout_timer: self.button_timeout_timer.cancel()
@@ -283,21 +347,73 @@ class AttendanceSystem:
         self.rescan_counter = 0 # Reset timeout
         
         self.last_box_coords = None
+        self.tracker.stop()
         
-        self.ui_status.update({
+        self.set_status({
             "name": "", "subtext": "", "name_color": "#333333",
             "show_button": False
         })
 
-    def process_frame(self):
-        frame = self.camera.get_frame()
-        if frame is None: return None
-
-        frame = cv2.flip(frame, 1)
-        h, w, _ = frame.shape
+    @staticmethod
+    def expand_roi(box, w, h):
+        t, r, b, l = box
+        pad_w, pad_h = int((r - l) * config.ROI_MARGIN), int((b - t) * config.ROI_MARGIN)
+        return max(0, t - pad_h), min(w, r + pad_w), min(h, b + pad_h), max(0, l - pad_w)
+
+    def detect_face(self, small_rgb, roi=None):
+        """Largest plausible face as (t, r, b, l) in detection pixels, searching only roi if given"""
+        h, w = small_rgb.shape[:2]
+        off_y, off_x = 0, 0
+        image = small_rgb
+        if roi is not None:
+            t, r, b, l = roi
+            image = np.ascontiguousarray(small_rgb[t:b, l:r])
+            off_y, off_x = t, l
+        img_h, img_w = image.shape[:2]
+        if img_h == 0 or img_w == 0:
+            return None
+
+        results = self.mp_face.process(image)
+        if not results.detections:
+            return None
+
+        best, max_area = None, 0
+        for detection in results.detections:
+            bboxC = detection.location_data.relative_bounding_box
+            # Size and shape limits are relative to the whole frame, not the ROI
+            rel_w, rel_h = bboxC.width * img_w / w, bboxC.height * img_h / h
+            if (rel_w * rel_h) < config.MIN_FACE_AREA: continue
+            ratio = rel_w / rel_h
+            if ratio < 0.5 or ratio > 1.5: continue
+
+            x = int(bboxC.xmin * img_w) + off_x
+            y = int(bboxC.ymin * img_h) + off_y
+            bw = int(bboxC.width * img_w)
+            bh = int(bboxC.height * img_h)
+
+            x, y = max(0, x), max(0, y)
+
+            area = bw * bh
+            if area > max_area:
+                max_area = area
+                best = (y, x+bw, y+bh, x)
+        return best
+
+    def process_frame(self, frames):
+        """Run one camera.get_frame() result through the state machine; returns the display frame"""
+        if frames is None: return None
+
+        # frame: mirrored preview; small_rgb/small_gray: detection-size copies (see CameraManager)
+        frame, small_rgb, small_gray = frames
+        h, w = small_gray.shape[:2]
+
+        # Idle: scanning, no face on screen and nothing moving. The gate sees
+        # every frame, so the first frame with motion is processed in full.
+        moving = self.motion.update(small_gray)
+        if config.ENABLE_MOTION_GATE and not moving and \
+                self.state == self.STATE_SCANNING and not self.last_box_coords:
+            return frame
         
-        small_frame = cv2.resize(frame, (0, 0), fx=config.PROCESS_SCALE, fy=config.PROCESS_SCALE)
-        scale = 1.0 / config.PROCESS_SCALE
         box_color = (0, 165, 255) # Orange (Default)
         self.scan_counter += 1
 
@@ -305,38 +421,40 @@ class AttendanceSystem:
         should_detect = (self.state == self.STATE_SCANNING and self.scan_counter % 2 == 0) or \
                         (self.state in [self.STATE_VERIFYING, self.STATE_READY] and self.scan_counter % 3 == 0)
 
+        # Between detections the tracker moves the box with the face. The
+        # detector runs again on its own schedule, or at once if tracking is lost.
+        if self.tracker.active and self.state != self.STATE_MARKED:
+            tracked_box = self.tracker.update(small_gray)
+            if tracked_box:
+                self.last_box_coords = self.camera.to_display(tracked_box)
+                should_detect = self.scan_counter % config.TRACK_REDETECT_FRAMES == 0
+            else:
+                should_detect = True
+
         found_box_scaled = None 
+        found_box_small = None
 
         if should_detect:
-            small_rgb = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-            results = self.mp_face.process(small_rgb)
-            
-            if results.detections:
-                max_area = 0
-                for detection in results.detections:
-                    bboxC = detection.location_data.relative_bounding_box
-                    if (bboxC.width * bboxC.height) < config.MIN_FACE_AREA: continue 
-                    ratio = bboxC.width / bboxC.height
-                    if ratio < 0.5 or ratio > 1.5: continue
-
-                    ih, iw, _ = small_frame.shape
-                    x = int(bboxC.xmin * iw)
-                    y = int(bboxC.ymin * ih)
-                    bw = int(bboxC.width * iw)
-                    bh = int(bboxC.height * ih)
-                    x, y = max(0, x), max(0, y)
-                    
-                    area = bw * bh
-                    if area > max_area:
-                        max_area = area
-                        found_box_scaled = (int(y*scale), int((x+bw)*scale), int((y+bh)*scale), int(x*scale))
+            roi = None
+            if self.state in [self.STATE_VERIFYING, self.STATE_READY] and self.last_box_coords:
+                # Engaged user: search only around their face, full frame only on loss
+                roi = self.expand_roi(self.camera.to_detect(self.last_box_coords), w, h)
+            found_box_small = self.detect_face(small_rgb, roi)
+            if found_box_small is None and roi is not None:
+                found_box_small = self.detect_face(small_rgb)
+            if found_box_small:
+                found_box_scaled = self.camera.to_display(found_box_small)
 
         # 2. PERSISTENCE
         if should_detect:
             if found_box_scaled:
                 self.last_box_coords = found_box_scaled
                 self.missed_frame_count = 0
+                if config.ENABLE_TRACKER:
+                    # Re-anchor on the detection so tracking drift never builds up
+                    self.tracker.start(small_gray, found_box_small)
             else:
+                self.tracker.stop()
                 self.missed_frame_count += 1
                 if self.missed_frame_count >= 2:
                     self.match_streak = 0
@@ -356,13 +474,8 @@ class AttendanceSystem:
                     self.stabilization_counter += 1
                     box_color = (0, 255, 255) # Yellow
                 else:
-                    t, r, b, l = self.last_box_coords
-                    small_box = (
-                        int(t * config.PROCESS_SCALE), int(r * config.PROCESS_SCALE),
-                        int(b * config.PROCESS_SCALE), int(l * config.PROCESS_SCALE)
-                    )
+                    small_box = self.camera.to_detect(self.last_box_coords)
                     
-                    small_rgb = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
                     result = self.face_system.recognize_from_box(small_rgb, small_box)
 
                     detected_id = result.get('id')
@@ -381,7 +494,7 @@ class AttendanceSystem:
                             self.match_streak = 0 
                             self.rescan_counter = 0 # Start Rescan Timer
                             
-                            self.ui_status.update({
+                            self.set_status({
                                 "name": f"{result['name']} - {result['desig']}",
                                 "name_color": "#0000AA", "subtext": "", "show_button": False
                             })
@@ -410,16 +523,15 @@ class AttendanceSystem:
                         self.state = self.STATE_READY
                         self.update_button_status()
                     else:
-                        self.ui_status.update({"subtext": "Please Turn Head Left/Right"})
+                        self.set_status({"subtext": "Please Turn Head Left/Right"})
                         try:
-                            t, r, b, l = self.last_box_coords
+                            t, r, b, l = self.camera.to_detect(self.last_box_coords)
                             pad_h, pad_w = int((b-t)*0.15), int((r-l)*0.15)
-                            small_t, small_b = max(0, int(t*config.PROCESS_SCALE)-pad_h), min(h, int(b*config.PROCESS_SCALE)+pad_h)
-                            small_l, small_r = max(0, int(l*config.PROCESS_SCALE)-pad_w), min(w, int(r*config.PROCESS_SCALE)+pad_w)
+                            small_t, small_b = max(0, t-pad_h), min(h, b+pad_h)
+                            small_l, small_r = max(0, l-pad_w), min(w, r+pad_w)
 
                             dlib_rect = dlib.rectangle(small_l, small_t, small_r, small_b)
-                            gray = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
-                            shape = self.face_system.predictor(gray, dlib_rect)
+                            shape = self.face_system.predictor(small_gray, dlib_rect)
                             
                             ratio = self.face_system.get_head_pose_ratio(shape)
                             
@@ -449,7 +561,7 @@ class AttendanceSystem:
         btn_text = "PUNCH OUT" if status == 'in' else "PUNCH IN"
         btn_color = "#D32F2F" if status == 'in' else "#388E3C"
         
-        self.ui_status.update({ "subtext": "", "show_button": True, "button_text": btn_text, "button_color": btn_color })
+        self.set_status({ "subtext": "", "show_button": True, "button_text": btn_text, "button_color": btn_color })
         
         if self.button_timeout_timer: self.button_timeout_timer.cancel()
         self.button_timeout_timer = threading.Timer(config.BUTTON_TIMEOUT, self.reset_to_scanning)
@@ -463,40 +575,195 @@ class AttendanceSystem:
         msg, color, _ = DatabaseManager.mark_attendance(e_id, name)
         
         self.state = self.STATE_MARKED
-        self.ui_status.update({ "name": msg, "name_color": color, "subtext": f"Time: {datetime.now().strftime('%H:%M:%S')}", "show_button": False })
+        self.set_status({ "name": msg, "name_color": color, "subtext": f"Time: {datetime.now().strftime('%H:%M:%S')}", "show_button": False })
         
         self.last_box_coords = None
+        self.tracker.stop()
         self.reset_timer = threading.Timer(config.RESET_TIME_AFTER_PUNCH, self.reset_to_scanning)
         self.reset_timer.start()
 
+# ==========================================
+# 5. VIDEO BROADCAST
+# ==========================================
+class FrameBroadcaster:
+    """
+    One producer thread runs process_frame and JPEG-encodes each result once;
+    every /video_feed client streams from that shared buffer. A client that
+    falls behind jumps to the newest frame, the producer never waits for it.
+    Nothing is processed while no client is connected.
+
+    With STREAM_ADAPTIVE the encode follows the load: a frame is only
+    encoded when some client is ready to send it, and size/quality step
+    down the STREAM_LADDER while processing + encoding overruns the frame
+    budget (1 / FPS), and back up once there is headroom again. Time spent
+    waiting for the camera is not counted: a camera slower than FPS must
+    not push the stream down the ladder while the CPU is idle.
+    """
+    # Frames between ladder moves, so one slow frame does not flip the quality
+    ADAPT_EVERY = 15
+    HEADROOM = 0.6
+
+    def __init__(self, system):
+        self.system = system
+        self._cond = threading.Condition()
+        self._jpeg = None
+        self._seq = 0
+        self._clients = 0
+        self._waiting = 0
+        self.level = 0
+        self._cost = 0.0
+        self._since_adapt = 0
+        # Called on the producer thread after each new frame (async server hook)
+        self.listeners = []
+        self._thread = threading.Thread(target=self._run, name="video-producer", daemon=True)
+        self._thread.start()
+
+    def _adapt(self, cost):
+        # Exponential moving average of seconds spent per frame
+        self._cost = cost if not self._cost else 0.9 * self._cost + 0.1 * cost
+        self._since_adapt += 1
+        if self._since_adapt < self.ADAPT_EVERY:
+            return
+        budget = 1.0 / config.FPS
+        if self._cost > budget and self.level < len(config.STREAM_LADDER) - 1:
+            self.level += 1
+        elif self._cost < self.HEADROOM * budget and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        # Measure the new level from scratch
+        self._since_adapt = 0
+        self._cost = 0.0
+
+    def _encode(self, frame):
+        scale, quality = config.STREAM_LADDER[self.level]
+        if scale != 1.0:
+            # Shrink before the colour conversion so both work on fewer pixels
+            frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        ret, buffer = cv2.imencode('.jpg', rgb_frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        return buffer.tobytes() if ret else None
+
+    def _run(self):
+        budget = 1.0 / config.FPS
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._clients > 0)
+
+            # Paced by the camera: get_frame waits for the next captured frame
+            start = time.perf_counter()
+            try:
+                frames = self.system.camera.get_frame()
+                compute_start = time.perf_counter()
+                frame = self.system.process_frame(frames)
+            except Exception as e:
+                print(f"[ERROR] Frame processing failed: {e}")
+                time.sleep(0.1)
+                continue
+            if frame is None:
+                continue
+
+            # Every frame drives the state machine, but only frames a client
+            # can take right now are worth encoding
+            if config.STREAM_ADAPTIVE and not self._waiting:
+                continue
+
+            frame_bytes = self._encode(frame)
+            if frame_bytes is None:
+                continue
+            with self._cond:
+                self._jpeg = frame_bytes
+                self._seq += 1
+                self._cond.notify_all()
+            for listener in self.listeners:
+                listener()
+
+            now = time.perf_counter()
+            if config.STREAM_ADAPTIVE:
+                self._adapt(now - compute_start)
+            # Only what is left of the frame budget, never a fixed interval
+            elapsed = now - start
+            if elapsed < budget:
+                time.sleep(budget - elapsed)
+
+    def connect(self):
+        with self._cond:
+            self._clients += 1
+            self._cond.notify_all()
+
+    def disconnect(self):
+        with self._cond:
+            self._clients -= 1
+
+    def mark_waiting(self, delta):
+        """+1 while a client waits for a frame it could send right away, -1 after"""
+        with self._cond:
+            self._waiting += delta
+
+    def latest(self):
+        with self._cond:
+            return self._seq, self._jpeg
+
+    @staticmethod
+    def part(frame_bytes):
+        return (b'--frame\r\n'
+                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+
+    def frames(self):
+        seen = 0
+        self.connect()
+        try:
+            while True:
+                with self._cond:
+                    self._waiting += 1
+                    try:
+                        fresh = self._cond.wait_for(lambda: self._seq != seen, timeout=1.0)
+                    finally:
+                        self._waiting -= 1
+                    if not fresh:
+                        continue
+                    seen, frame_bytes = self._seq, self._jpeg
+                yield self.part(frame_bytes)
+        finally:
+            # Runs when the client disconnects and the generator is closed
+            self.disconnect()
+
 # Initialize System
 system = AttendanceSystem()
+broadcaster = FrameBroadcaster(system)
 
 # ==========================================
-# 5. FLASK ROUTES
+# 6. FLASK ROUTES
 # ==========================================
 @app.route('/')
 def index():
     return render_template('index.html')
 
-def gen_frames():
-    while True:
-        frame = system.process_frame()
-        if frame is not None:
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            ret, buffer = cv2.imencode('.jpg', rgb_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        time.sleep(1.0 / config.FPS)
-
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(broadcaster.frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/status')
 def status():
-    return jsonify(system.ui_status)
+    ui_status, version = system.get_status()
+    return jsonify(dict(ui_status, version=version))
+
+def status_events(since):
+    while True:
+        update = system.wait_status(since, timeout=config.STATUS_KEEPALIVE)
+        if update is None:
+            # Comment line: keeps proxies and the browser from timing out
+            yield ": keep-alive\n\n"
+            continue
+        ui_status, since = update
+        yield f"id: {since}\ndata: {json.dumps(dict(ui_status, version=since))}\n\n"
+
+@app.route('/status/stream')
+def status_stream():
+    # EventSource resends the last id on reconnect; anything else gets the current status at once
+    since = request.headers.get('Last-Event-ID', type=int, default=0)
+    return Response(status_events(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/punch_action', methods=['POST'])
 def punch_action():
@@ -504,4 +771,9 @@ def punch_action():
     return jsonify({"success": True})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
+    if config.WEB_SERVER == "asgi":
+        # One event loop for every stream and poll instead of a thread each
+        import f_asgi
+        f_asgi.serve(system, broadcaster, host='0.0.0.0', port=5000)
+    else:
+        app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI server for the web kiosk, used when config.WEB_SERVER = "asgi"
+(requires starlette and uvicorn). Serves the same routes as f_app.py from
+one event loop: MJPEG streams, SSE and polls are coroutines instead of a
+Werkzeug thread each. Frame processing stays on the FrameBroadcaster
+producer thread and punches run in the threadpool, so the loop only moves
+bytes that are already encoded.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+import config
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+class LoopSignal:
+    """Lets a worker thread wake every coroutine waiting on the event loop"""
+
+    def __init__(self):
+        self.loop = None
+        self._event = None
+
+    def bind(self, loop):
+        self._event = asyncio.Event()
+        self.loop = loop
+
+    def fire(self):
+        # Called from the producer / state-machine threads
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._fire)
+
+    def _fire(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def wait(self, timeout):
+        """True if fired, False on timeout"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def create_app(system, broadcaster):
+    frame_signal = LoopSignal()
+    status_signal = LoopSignal()
+    broadcaster.listeners.append(frame_signal.fire)
+    system.status_listeners.append(status_signal.fire)
+    templates = Jinja2Templates(directory=TEMPLATE_DIR)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        loop = asyncio.get_running_loop()
+        frame_signal.bind(loop)
+        status_signal.bind(loop)
+        yield
+
+    async def index(request):
+        return templates.TemplateResponse("index.html", {"request": request})
+
+    async def frames():
+        seen = 0
+        broadcaster.connect()
+        try:
+            while True:
+                seq, frame_bytes = broadcaster.latest()
+                if seq == seen:
+                    broadcaster.mark_waiting(1)
+                    try:
+                        await frame_signal.wait(1.0)
+                    finally:
+                        broadcaster.mark_waiting(-1)
+                    continue
+                seen = seq
+                yield broadcaster.part(frame_bytes)
+        finally:
+            # The response closes the generator when the client goes away
+            broadcaster.disconnect()
+
+    async def video_feed(request):
+        return StreamingResponse(frames(), media_type='multipart/x-mixed-replace; boundary=frame')
+
+    async def status(request):
+        ui_status, version = system.get_status()
+        return JSONResponse(dict(ui_status, version=version))
+
+    async def status_events(since):
+        while True:
+            ui_status, version = system.get_status()
+            if version == since:
+                if not await status_signal.wait(config.STATUS_KEEPALIVE):
+                    yield ": keep-alive\n\n"
+                continue
+            since = version
+            yield f"id: {since}\ndata: {json.dumps(dict(ui_status, version=since))}\n\n"
+
+    async def status_stream(request):
+        try:
+            since = int(request.headers.get('last-event-id', 0))
+        except ValueError:
+            since = 0
+        return StreamingResponse(status_events(since), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    async def punch_action(request):
+        # Touches the state machine and the punch journal; keep it off the loop
+        await run_in_threadpool(system.handle_punch)
+        return JSONResponse({"success": True})
+
+    return Starlette(routes=[
+        Route('/', index),
+        Route('/video_feed', video_feed),
+        Route('/status', status),
+        Route('/status/stream', status_stream),
+        Route('/punch_action', punch_action, methods=['POST']),
+    ], lifespan=lifespan)
+
+
+def serve(system, broadcaster, host='0.0.0.0', port=5000):
+    uvicorn.run(create_app(system, broadcaster), host=host, port=port, log_level="warning")
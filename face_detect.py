@@ -19,22 +19,22 @@ from kivy.core.window import Window
 
 import numpy as np
 import cv2
-import base64
 import face_recognition
 import dlib
-import mysql.connector
 from mysql.connector import Error
 from datetime import datetime
 from scipy.spatial import distance as dist
 import config
+from db import get_conn
+from migrations import migrate
+from status_cache import day_bounds
+from gallery import encoding_from_blob
 
 # ---------------- Config ----------------
 b_dir = "/home/pi/face_attendance/"
 
 
 
-def get_conn():
-    return mysql.connector.connect(**config.DB_CONFIG)
 
 subprocess.run(["wlr-randr", "--output", "DSI-1", "--on"])
 
@@ -45,43 +45,23 @@ Window.clearcolor = (0.93, 0.95, 1, 1)
 
 
 # ---------------- Database Utilities ----------------
-def create_attendance_table():
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS attendance (
-            id INT PRIMARY KEY AUTO_INCREMENT,
-            emp_id INT NOT NULL,
-            name VARCHAR(255) NOT NULL,
-            status VARCHAR(20) NOT NULL,
-            timestamp DATETIME NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-
 def get_face_data_from_db():
     conn = get_conn()
     cursor = conn.cursor()
-    cursor.execute("SELECT emp_id, name, designation, encodings FROM info")
+    cursor.execute("SELECT emp_id, name, designation, encoding FROM info")
     rows = cursor.fetchall()
     conn.close()
 
     emp_ids, names, designations, encodings = [], [], [], []
 
-    for emp_id, name, desig, enc_b64 in rows:
+    for emp_id, name, desig, blob in rows:
         try:
-            if not enc_b64:
+            if not blob:
                 continue
 
-            arr_bytes = base64.b64decode(enc_b64)
-            face_encoding = np.frombuffer(arr_bytes, dtype=np.float64)
-
-            if face_encoding.size != 128:
-                face_encoding = np.frombuffer(arr_bytes, dtype=np.float32)
+            face_encoding = encoding_from_blob(blob)
 
-            if face_encoding.size == 128:
+            if face_encoding is not None:
                 emp_ids.append(emp_id)
                 names.append(name)
                 designations.append(desig)
@@ -94,7 +74,7 @@ def get_face_data_from_db():
 
 
 def get_latest_record(emp_id):
-    today = datetime.now().strftime("%Y-%m-%d")
+    start, end = day_bounds(datetime.now().date())
 
     conn = get_conn()
     cursor = conn.cursor()
@@ -103,10 +83,10 @@ def get_latest_record(emp_id):
         SELECT id, emp_id, name, status, timestamp
         FROM attendance
         WHERE emp_id = %s
-          AND DATE(timestamp) = %s
+          AND timestamp >= %s AND timestamp < %s
         ORDER BY id DESC
         LIMIT 1
-    """, (emp_id, today))
+    """, (emp_id, start, end))
 
     record = cursor.fetchone()
     conn.close()
@@ -184,7 +164,7 @@ class DetectApp(App):
     VERIFIED_DISPLAY_TIME = 5
 
     def build(self):
-        create_attendance_table()
+        migrate()
         self.emp_ids, self.names, self.designations, self.encodings = get_face_data_from_db()
         print(f"[INFO] Loaded {len(self.emp_ids)} employees from database.")
 
@@ -332,7 +312,7 @@ class DetectApp(App):
                 continue
 
             face_locations = [(y, x + w, y + h, x)]
-            encodings = face_recognition.face_encodings(rgb, face_locations)
+            encodings = face_recognition.face_encodings(rgb, face_locations, model="large")
 
             if encodings:
                 face_encoding = encodings[0]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import cv2
+import numpy as np
+
+LK_PARAMS = dict(
+    winSize=(15, 15),
+    maxLevel=2,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+)
+
+
+class FlowTracker:
+    """
+    Median-flow face tracker for the frames between detections.
+
+    Corner points inside the detected box are followed with pyramidal
+    Lucas-Kanade. Points whose backward flow does not land where they
+    started are dropped; the box moves by the median displacement of the
+    rest and scales by the median change of their pairwise distances.
+    Boxes are (top, right, bottom, left) in detection-frame pixels.
+    update() returns None when too few points survive, which is the cue to
+    run the detector again.
+    """
+
+    def __init__(self, max_points=40, min_points=8, max_fb_error=1.0):
+        self.max_points = max_points
+        self.min_points = min_points
+        self.max_fb_error = max_fb_error
+        self.stop()
+
+    @property
+    def active(self):
+        return self.box is not None
+
+    def stop(self):
+        self.box = None
+        self._gray = None
+        self._points = None
+
+    def start(self, gray, box):
+        t, r, b, l = box
+        mask = np.zeros(gray.shape[:2], dtype=np.uint8)
+        mask[max(t, 0):max(b, 0), max(l, 0):max(r, 0)] = 255
+        points = cv2.goodFeaturesToTrack(gray, self.max_points, 0.01, 3, mask=mask)
+        if points is None or len(points) < self.min_points:
+            self.stop()
+            return False
+        self.box = box
+        self._gray = gray
+        self._points = points.astype(np.float32)
+        return True
+
+    def update(self, gray):
+        if not self.active:
+            return None
+
+        new, st, _ = cv2.calcOpticalFlowPyrLK(self._gray, gray, self._points, None, **LK_PARAMS)
+        back, st_back, _ = cv2.calcOpticalFlowPyrLK(gray, self._gray, new, None, **LK_PARAMS)
+        fb_error = np.linalg.norm(self._points - back, axis=2).ravel()
+        good = (st.ravel() == 1) & (st_back.ravel() == 1) & (fb_error < self.max_fb_error)
+        if good.sum() < self.min_points:
+            self.stop()
+            return None
+
+        old_pts = self._points[good].reshape(-1, 2)
+        new_pts = new[good].reshape(-1, 2)
+        dx, dy = np.median(new_pts - old_pts, axis=0)
+
+        # Scale from how pairwise distances changed (robust to a few bad points)
+        i, j = np.triu_indices(len(old_pts), k=1)
+        old_d = np.linalg.norm(old_pts[i] - old_pts[j], axis=1)
+        new_d = np.linalg.norm(new_pts[i] - new_pts[j], axis=1)
+        valid = old_d > 1e-3
+        scale = float(np.median(new_d[valid] / old_d[valid])) if valid.any() else 1.0
+
+        t, r, b, l = self.box
+        cx, cy = (l + r) / 2.0 + dx, (t + b) / 2.0 + dy
+        half_w, half_h = (r - l) * scale / 2.0, (b - t) * scale / 2.0
+        h, w = gray.shape[:2]
+        if not (0 <= cx < w and 0 <= cy < h):
+            self.stop()
+            return None
+
+        self.box = (max(int(cy - half_h), 0), min(int(cx + half_w), w - 1),
+                    min(int(cy + half_h), h - 1), max(int(cx - half_w), 0))
+        self._gray = gray
+        self._points = new_pts.reshape(-1, 1, 2)
+        return self.box
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class FrameGrabber:
+    """
+    Reads the camera on its own thread and keeps only the newest frame.
+
+    The processing loop picks up whatever was captured last instead of
+    waiting for the sensor, and frames it was too slow for are simply
+    dropped, so no backlog can build up.
+    """
+
+    def __init__(self, read_frame, retry_delay=0.05):
+        self._read_frame = read_frame
+        self._retry_delay = retry_delay
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._taken = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            try:
+                frame = self._read_frame()
+            except Exception as e:
+                print(f"[CAM] Capture failed: {e}")
+                frame = None
+
+            if frame is None:
+                time.sleep(self._retry_delay)
+                continue
+
+            with self._cond:
+                # Replacing the reference drops the previous frame if nobody took it
+                self._frame = frame
+                self._seq += 1
+                self._cond.notify_all()
+
+    def latest(self, timeout=1.0):
+        """
+        Newest captured frame. Only blocks (up to timeout) when the caller
+        already has it, so the same frame is never processed twice.
+        Returns None if nothing new arrived in time.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq != self._taken, timeout):
+                return None
+            self._taken = self._seq
+            return self._frame
+
+    def peek(self):
+        """(sequence number, newest frame) without waiting or marking it taken"""
+        with self._cond:
+            return self._seq, self._frame
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=2.0)
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from queries import GALLERY_DELTA_SQL, GALLERY_ROWS_SQL
+
+EMBEDDING_DIM = 128
+
+# Rows written inside a transaction carry NOW() from before their commit, so the
+# delta query looks back a little past the watermark to catch late commits.
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+ID_BATCH_SIZE = 500
+
+# Bump when the snapshot layout changes; older snapshots are then ignored
+SNAPSHOT_VERSION = 4
+
+
+def encoding_to_blob(encoding):
+    """128-d vector -> info.encoding value (fixed 512 bytes, little-endian float32)"""
+    return np.asarray(encoding, dtype='<f4').tobytes()
+
+
+def encoding_from_blob(blob):
+    """info.encoding value -> 128-d float32 vector, or None if malformed"""
+    face_encoding = np.frombuffer(bytes(blob), dtype='<f4')
+    if face_encoding.size != EMBEDDING_DIM:
+        return None
+    return face_encoding
+
+
+def decode_encoding(enc_b64):
+    """Decode a legacy info.encodings base64 value into a 128-d vector, or None if malformed"""
+    arr_bytes = base64.b64decode(enc_b64)
+    face_encoding = np.frombuffer(arr_bytes, dtype=np.float64)
+    if face_encoding.size != EMBEDDING_DIM:
+        face_encoding = np.frombuffer(arr_bytes, dtype=np.float32)
+    if face_encoding.size != EMBEDDING_DIM:
+        return None
+    return face_encoding
+
+
+class FaceGallery:
+    """
+    Enrolled faces packed into one contiguous float32 matrix.
+
+    Squared norms are kept next to the matrix, so matching a probe is a
+    single matrix-vector product:  |g - p|^2 = |g|^2 - 2 g.p + |p|^2
+    Rows are keyed by info.id and patched in place; storage is preallocated
+    and only grows (doubling) when it runs out of room. An optional index
+    (see ivf_index.py) narrows which rows are checked for large galleries.
+    """
+
+    def __init__(self, capacity=256, index=None):
+        self.lock = threading.RLock()
+        self.row_ids, self.emp_ids, self.names, self.designations = [], [], [], []
+        self._slots = {}
+        self._matrix = np.empty((max(capacity, 1), EMBEDDING_DIM), dtype=np.float32)
+        self._sq_norms = np.empty(max(capacity, 1), dtype=np.float32)
+        self._mapped = False
+        self._segments = None
+        self.index = index
+
+    @classmethod
+    def from_arrays(cls, matrix, row_ids, emp_ids, names, designations, index=None, sq_norms=None):
+        """
+        Wrap an existing (possibly read-only, memory-mapped) matrix without
+        copying it. Pass sq_norms when known, so the rows are not read just
+        to compute them.
+        """
+        gallery = cls(capacity=1, index=index)
+        gallery.row_ids, gallery.emp_ids = list(row_ids), list(emp_ids)
+        gallery.names, gallery.designations = list(names), list(designations)
+        gallery._slots = {row_id: slot for slot, row_id in enumerate(gallery.row_ids)}
+        gallery._matrix = matrix
+        if sq_norms is None:
+            sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        gallery._sq_norms = np.array(sq_norms, dtype=np.float32)
+        gallery._mapped = not matrix.flags.writeable
+        return gallery
+
+    def _identity_segments(self):
+        """
+        Rows grouped by emp_id: (order, starts, counts, first, identity)
+        where order lists slots sorted by emp_id, starts/counts delimit each
+        identity inside it, first is one representative slot per identity and
+        identity maps each slot back to its identity number.
+        Rebuilt lazily after rows are added, removed or re-assigned.
+        """
+        if self._segments is None:
+            emp_ids = np.array([-1 if e is None else e for e in self.emp_ids], dtype=np.int64)
+            order = np.argsort(emp_ids, kind='stable')
+            sorted_ids = emp_ids[order]
+            starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+            counts = np.diff(np.r_[starts, len(order)])
+            identity = np.empty(len(order), dtype=np.int64)
+            identity[order] = np.repeat(np.arange(len(starts)), counts)
+            self._segments = (order, starts, counts, order[starts], identity)
+        return self._segments
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self, row_id):
+        return row_id in self._slots
+
+    @property
+    def matrix(self):
+        return self._matrix[:len(self.row_ids)]
+
+    @property
+    def sq_norms(self):
+        return self._sq_norms[:len(self.row_ids)]
+
+    def _grow(self, capacity=None):
+        capacity = capacity or len(self._matrix) * 2
+        matrix = np.empty((capacity, EMBEDDING_DIM), dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        n = len(self.row_ids)
+        matrix[:n] = self._matrix[:n]
+        sq_norms[:n] = self._sq_norms[:n]
+        self._matrix, self._sq_norms = matrix, sq_norms
+        self._mapped = False
+
+    def upsert(self, row_id, emp_id, name, designation, encoding):
+        with self.lock:
+            if self._mapped:
+                # First patch after loading a snapshot: copy off the mapping
+                self._grow(len(self.row_ids) * 2 + 1)
+            slot = self._slots.get(row_id)
+            if slot is None:
+                slot = len(self.row_ids)
+                if slot == len(self._matrix):
+                    self._grow()
+                self._slots[row_id] = slot
+                self.row_ids.append(row_id)
+                self.emp_ids.append(emp_id)
+                self.names.append(name)
+                self.designations.append(designation)
+                self._segments = None
+            else:
+                if self.emp_ids[slot] != emp_id:
+                    self._segments = None
+                self.emp_ids[slot] = emp_id
+                self.names[slot] = name
+                self.designations[slot] = designation
+
+            row = self._matrix[slot]
+            row[:] = encoding
+            self._sq_norms[slot] = row @ row
+            if self.index is not None:
+                self.index.add(slot, row)
+
+    def remove(self, row_id):
+        with self.lock:
+            if row_id not in self._slots:
+                return False
+            if self._mapped:
+                self._grow(len(self.row_ids) * 2 + 1)
+            slot = self._slots.pop(row_id)
+
+            # Move the last row into the hole so the matrix stays dense
+            last = len(self.row_ids) - 1
+            if slot != last:
+                self._matrix[slot] = self._matrix[last]
+                self._sq_norms[slot] = self._sq_norms[last]
+                for column in (self.row_ids, self.emp_ids, self.names, self.designations):
+                    column[slot] = column[last]
+                self._slots[self.row_ids[slot]] = slot
+                if self.index is not None:
+                    self.index.move(last, slot)
+
+            for column in (self.row_ids, self.emp_ids, self.names, self.designations):
+                column.pop()
+            self._segments = None
+            return True
+
+    def train_index(self):
+        """(Re)train the index when the gallery size calls for it; a no-op otherwise"""
+        with self.lock:
+            if self.index is not None and self.index.needs_training(len(self)):
+                self.index.train(self.matrix)
+
+    def distances(self, probe, slots=None):
+        probe = np.asarray(probe, dtype=np.float32)
+        with self.lock:
+            if slots is None:
+                d2 = self.matrix @ probe
+                d2 *= -2.0
+                d2 += self.sq_norms
+            else:
+                d2 = self._matrix[slots] @ probe
+                d2 *= -2.0
+                d2 += self._sq_norms[slots]
+        d2 += probe @ probe
+        # Rounding can push near-identical vectors slightly below zero
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def _expand_identities(self, slots, segments):
+        """
+        Every photo of each employee appearing in slots, laid out for reduceat:
+        (slots, starts, identities)
+        """
+        order, starts, counts, first, identity = segments
+        identities = np.unique(identity[slots])
+        lens = counts[identities]
+        ends = np.cumsum(lens)
+        local_starts = ends - lens
+        gather = np.repeat(starts[identities] - local_starts, lens) + np.arange(ends[-1])
+        return order[gather], local_starts, identities
+
+    def _identity_scores(self, probe, aggregation, use_index=True):
+        """(scores, identities): per-employee distances; identities None = all employees in segment order"""
+        segments = self._identity_segments()
+        order, starts, counts, first, identity = segments
+
+        found = None
+        if use_index and self.index is not None:
+            found = self.index.search(probe, self.matrix, self.sq_norms)
+            if found is not None and len(found[0]) == 0:
+                # Every probed bucket was empty: scan the whole gallery instead
+                found = None
+
+        if found is None:
+            face_distances = self.distances(probe)[order]
+            if aggregation == 'mean':
+                return np.add.reduceat(face_distances, starts) / counts, None
+            return np.minimum.reduceat(face_distances, starts), None
+
+        slots, face_distances = found
+        if aggregation == 'mean':
+            # A mean needs all of an employee's photos, not just the ones the index found
+            slots, seg_starts, identities = self._expand_identities(slots, segments)
+            return np.add.reduceat(self.distances(probe, slots), seg_starts) / counts[identities], identities
+
+        ids = identity[slots]
+        by_id = np.argsort(ids, kind='stable')
+        ids = ids[by_id]
+        seg_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        return np.minimum.reduceat(face_distances[by_id], seg_starts), ids[seg_starts]
+
+    def best_two(self, probe, aggregation='min'):
+        """
+        Return [(emp_id, name, designation, distance), ...] for the closest
+        (at most two) distinct employees, best first. An employee enrolled
+        with several photos is scored by the min or mean of their distances.
+        """
+        probe = np.asarray(probe, dtype=np.float32)
+        with self.lock:
+            if len(self) == 0:
+                return []
+
+            scores, identities = self._identity_scores(probe, aggregation)
+            if identities is not None and len(identities) < 2:
+                # The index found a single employee; the gap rule needs a runner-up
+                scores, identities = self._identity_scores(probe, aggregation, use_index=False)
+
+            if len(scores) > 2:
+                top = np.argpartition(scores, 1)[:2]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(scores[top])]
+
+            first = self._identity_segments()[3]
+            top_slots = first[top] if identities is None else first[identities[top]]
+            return [
+                (self.emp_ids[slot], self.names[slot], self.designations[slot], float(scores[i]))
+                for i, slot in zip(top, top_slots)
+            ]
+
+
+class GallerySync:
+    """
+    Keeps a FaceGallery in step with the info table.
+
+    The first refresh loads everything; later ones only fetch rows whose
+    updated_on moved past the watermark, plus rows whose id has never been
+    seen, and drop ids that disappeared from the table. Rows the overlap
+    window fetches again with the same updated_on are not re-applied, so
+    an idle database refreshes with nothing changed.
+    """
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+        self.watermark = None
+        self.known_rows = {}  # info.id -> updated_on last applied
+        # True while the snapshot on disk holds exactly this gallery
+        self.snapshot_saved = False
+
+    def _apply(self, rows):
+        changed = 0
+        for row_id, emp_id, name, desig, blob, updated_on in rows:
+            if updated_on is not None and self.known_rows.get(row_id) == updated_on:
+                continue
+            self.known_rows[row_id] = updated_on
+            if updated_on and (self.watermark is None or updated_on > self.watermark):
+                self.watermark = updated_on
+
+            face_encoding = None
+            if blob:
+                try:
+                    face_encoding = encoding_from_blob(blob)
+                except Exception as e:
+                    print(f"[ERROR] Could not process {name}: {e}")
+
+            if face_encoding is not None:
+                self.gallery.upsert(row_id, emp_id, name, desig, face_encoding)
+                changed += 1
+            elif self.gallery.remove(row_id):
+                changed += 1
+        return changed
+
+    def refresh(self, conn):
+        """Bring the gallery up to date; returns the number of rows added, changed or removed"""
+        cursor = conn.cursor()
+
+        if self.watermark is None and not self.known_rows:
+            cursor.execute(GALLERY_ROWS_SQL)
+            changed = self._apply(cursor.fetchall())
+            cursor.close()
+            self.gallery.train_index()
+            return changed
+
+        changed = 0
+        if self.watermark is not None:
+            cursor.execute(GALLERY_DELTA_SQL, (self.watermark - WATERMARK_OVERLAP,))
+            changed += self._apply(cursor.fetchall())
+
+        cursor.execute("SELECT id FROM info")
+        current_ids = {row[0] for row in cursor.fetchall()}
+
+        new_ids = list(current_ids - self.known_rows.keys())
+        for start in range(0, len(new_ids), ID_BATCH_SIZE):
+            batch = new_ids[start:start + ID_BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(GALLERY_ROWS_SQL + f" WHERE id IN ({placeholders})", batch)
+            changed += self._apply(cursor.fetchall())
+
+        for row_id in self.known_rows.keys() - current_ids:
+            del self.known_rows[row_id]
+            if self.gallery.remove(row_id):
+                changed += 1
+
+        cursor.close()
+        self.gallery.train_index()
+        return changed
+
+
+def _write_npy(filename, array):
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def save_snapshot(gallery_sync, path):
+    """
+    Write the gallery as a <path>.json sidecar (ids, names, designations,
+    watermark) pointing at a matrix and its squared norms saved under a
+    name unique to this save (<path>.<stamp>.npy, <path>.<stamp>.norms.npy).
+    The sidecar is renamed into place last, so a reader always gets the
+    arrays it names; the previous save's arrays are deleted afterwards.
+    """
+    gallery = gallery_sync.gallery
+    stamp = f"{datetime.now():%Y%m%d%H%M%S%f}-{os.getpid()}"
+    base = os.path.basename(path)
+    with gallery.lock:
+        matrix = np.array(gallery.matrix, dtype=np.float32)
+        sq_norms = np.array(gallery.sq_norms, dtype=np.float32)
+        meta = {
+            "version": SNAPSHOT_VERSION,
+            "created_at": datetime.now().isoformat(),
+            "matrix": f"{base}.{stamp}.npy",
+            "sq_norms": f"{base}.{stamp}.norms.npy",
+            "watermark": gallery_sync.watermark.isoformat() if gallery_sync.watermark else None,
+            "known_rows": [
+                [row_id, updated_on.isoformat() if updated_on else None]
+                for row_id, updated_on in gallery_sync.known_rows.items()
+            ],
+            "row_ids": list(gallery.row_ids),
+            "emp_ids": list(gallery.emp_ids),
+            "names": list(gallery.names),
+            "designations": list(gallery.designations),
+        }
+
+    folder = os.path.dirname(path)
+    try:
+        with open(path + ".json") as f:
+            old = json.load(f)
+        old_files = [os.path.join(folder, old[key]) for key in ("matrix", "sq_norms")]
+    except (OSError, ValueError, KeyError, TypeError):
+        # None yet, or an older layout with a fixed <path>.npy
+        old_files = [path + ".npy"]
+
+    _write_npy(os.path.join(folder, meta["matrix"]), matrix)
+    _write_npy(os.path.join(folder, meta["sq_norms"]), sq_norms)
+    tmp = f"{path}.json.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path + ".json")
+    gallery_sync.snapshot_saved = True
+
+    # Kiosks that mapped the old matrix keep their mapping after the unlink
+    for filename in old_files:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def update_snapshot(gallery_sync, path, changed):
+    """
+    Keep the snapshot in step after a refresh. When nothing changed, the
+    sidecar's mtime is bumped instead of rewriting the files: load_snapshot
+    ages a snapshot by when it was last known to match the database.
+    """
+    if changed or not gallery_sync.snapshot_saved:
+        save_snapshot(gallery_sync, path)
+        return
+    try:
+        os.utime(path + ".json")
+    except OSError:
+        gallery_sync.snapshot_saved = False
+        raise
+
+
+def load_snapshot(path, max_age=None, index=None):
+    """
+    Memory-map a snapshot written by save_snapshot and return a GallerySync
+    for it, or None when it is missing, from another version, or not
+    confirmed against the database (see update_snapshot) within max_age
+    (a timedelta) - the caller then loads from the database. Only the
+    sidecar and the norms are read; matrix pages load as matching needs them.
+    The index, if any, is trained by the first refresh.
+    """
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if meta.get("version") != SNAPSHOT_VERSION:
+            return None
+        if max_age is not None:
+            checked_at = datetime.fromtimestamp(os.path.getmtime(path + ".json"))
+            if datetime.now() - checked_at > max_age:
+                return None
+
+        folder = os.path.dirname(path)
+        matrix = np.load(os.path.join(folder, meta["matrix"]), mmap_mode='r')
+        sq_norms = np.load(os.path.join(folder, meta["sq_norms"]))
+        n = len(meta["row_ids"])
+        if matrix.dtype != np.float32 or matrix.shape != (n, EMBEDDING_DIM) or sq_norms.shape != (n,):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    gallery = FaceGallery.from_arrays(
+        matrix, meta["row_ids"], meta["emp_ids"], meta["names"], meta["designations"],
+        index=index, sq_norms=sq_norms
+    )
+    gallery_sync = GallerySync(gallery)
+    gallery_sync.known_rows = {
+        row_id: datetime.fromisoformat(updated_on) if updated_on else None
+        for row_id, updated_on in meta["known_rows"]
+    }
+    if meta["watermark"]:
+        gallery_sync.watermark = datetime.fromisoformat(meta["watermark"])
+    gallery_sync.snapshot_saved = True
+    return gallery_sync
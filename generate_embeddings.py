@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 #!/home/pi/acs/acsenv/bin/python
 
+import os
+import time
+import threading
+import multiprocessing
 import cv2
 import face_recognition
 import base64
@@ -8,77 +12,189 @@ import numpy as np
 import mysql.connector
 from mysql.connector import Error
 import config
+from db import get_conn
+from gallery import FaceGallery, GallerySync, save_snapshot, encoding_to_blob
+from migrations import migrate
 
+# Rows pulled from the server per round trip while streaming
+FETCH_SIZE = 32
+# UPDATEs sent per executemany / commit
+WRITE_BATCH = 50
+# Print throughput every this many rows
+REPORT_EVERY = 100
 
-def get_connection():
-    return mysql.connector.connect(**config.DB_CONFIG)
 
-def main():
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Fetch employees who have image but missing encodings
-        cursor.execute("""
-            SELECT emp_id, image 
-            FROM info 
-            WHERE image IS NOT NULL 
-              AND (encodings IS NULL OR encodings = '')
-        """)
-
-        rows = cursor.fetchall()
-        print(f"Total rows fetched: {len(rows)}")
-
-        for emp_id, image_data_url in rows:
-            try:
-                # Extract base64 from data:image URL
-                if image_data_url.startswith("data:image"):
-                    image_b64 = image_data_url.split(",")[1]
-                else:
-                    image_b64 = image_data_url
-
-                # Decode base64 ? numpy array
-                image_data = base64.b64decode(image_b64)
-                image_array = np.frombuffer(image_data, dtype=np.uint8)
-                img = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-
-                if img is None:
-                    print(f"Could not decode image for emp_id={emp_id}")
-                    continue
-
-                # Convert BGR ? RGB for face_recognition
-                rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                # Extract encodings
-                enc = face_recognition.face_encodings(rgb_img)
+def init_worker():
+    # One process per core already; stop OpenCV from spawning threads on top
+    cv2.setNumThreads(1)
 
-                if enc:
-                    encoding = enc[0]
-                    encoding_str = base64.b64encode(encoding.tobytes()).decode("utf-8")
 
-                    # Update MySQL record
-                    cursor.execute("""
-                        UPDATE info 
-                        SET encodings = %s 
-                        WHERE emp_id = %s
-                    """, (encoding_str, emp_id))
-
-                    print(f"Encoding saved for emp_id={emp_id}")
-
-                else:
-                    print(f"No face detected in image emp_id={emp_id}")
+def encode_row(row):
+    """Runs in a worker process: (row_id, emp_id, encoding blob or None, message)"""
+    row_id, emp_id, image_data_url = row
+    try:
+        # Extract base64 from data:image URL
+        if image_data_url.startswith("data:image"):
+            image_b64 = image_data_url.split(",")[1]
+        else:
+            image_b64 = image_data_url
+
+        # Decode base64 ? numpy array
+        image_data = base64.b64decode(image_b64)
+        image_array = np.frombuffer(image_data, dtype=np.uint8)
+        img = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+
+        if img is None:
+            return row_id, emp_id, None, f"Could not decode image for emp_id={emp_id} (row {row_id})"
+
+        # Convert BGR ? RGB for face_recognition
+        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        # Extract encodings, aligned on the 68-point landmarks the kiosks
+        # already compute for liveness (see migration 6)
+        enc = face_recognition.face_encodings(rgb_img, model="large")
+
+        if not enc:
+            return row_id, emp_id, None, f"No face detected in image emp_id={emp_id} (row {row_id})"
+
+        return row_id, emp_id, encoding_to_blob(enc[0]), None
+
+    except Exception as e:
+        return row_id, emp_id, None, f"Error processing emp_id={emp_id} (row {row_id}): {e}"
+
+
+def stream_rows(cursor, in_flight, stop):
+    """
+    Yields rows as the server sends them (unbuffered cursor, FETCH_SIZE at
+    a time). Blocks while in_flight is exhausted, so the pool never holds
+    more than its bound of photos in memory. Runs on the pool's task
+    thread; stop lets it exit so the pool can be shut down.
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            while not in_flight.acquire(timeout=0.5):
+                if stop.is_set():
+                    return
+            yield row
+
+
+def flush_updates(conn, updates):
+    # Keyed by info.id: every photo of an employee keeps its own encoding
+    cursor = conn.cursor()
+    cursor.executemany("""
+        UPDATE info 
+        SET encoding = %s, updated_on = NOW()
+        WHERE id = %s
+    """, updates)
+    conn.commit()
+    cursor.close()
+
+
+def reuse_known_encodings(conn):
+    """
+    Copies encodings onto pending photos whose content hash was already
+    encoded on another row, so unchanged images are never encoded twice.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE info pending
+        JOIN info known
+          ON known.image_hash = pending.image_hash AND known.id <> pending.id
+        SET pending.encoding = known.encoding, pending.updated_on = NOW()
+        WHERE pending.encoding IS NULL
+          AND known.encoding IS NOT NULL
+    """)
+    reused = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return reused
+
+
+def write_gallery_snapshot(conn):
+    # Full gallery for kiosks to memory-map at startup
+    gallery_sync = GallerySync(FaceGallery())
+    gallery_sync.refresh(conn)
+    save_snapshot(gallery_sync, config.GALLERY_SNAPSHOT_PATH)
+    print(f"Gallery snapshot written: {len(gallery_sync.gallery)} encodings.")
 
-            except Exception as e:
-                print(f"Error processing emp_id={emp_id}: {e}")
+def main():
+    workers = config.EMBEDDING_WORKERS or os.cpu_count()
+    # Workers are forked before any MySQL connection exists
+    pool = multiprocessing.Pool(workers, initializer=init_worker)
+    try:
+        migrate()
+        # Plain connection: an abandoned unbuffered result would stop a pooled
+        # one from being reset on close
+        read_conn = mysql.connector.connect(**config.DB_CONFIG)
+        conn = get_conn()
+        reused = reuse_known_encodings(conn)
+        print(f"Encodings reused for unchanged photos: {reused}")
+
+        # Unbuffered: rows stream from the server instead of all photos at once
+        read_cursor = read_conn.cursor(buffered=False)
+
+        # Fetch photos that have an image but no encoding yet
+        read_cursor.execute("""
+            SELECT i.id, i.emp_id, p.image
+            FROM info i
+            JOIN photos p ON p.image_hash = i.image_hash
+            WHERE i.encoding IS NULL
+        """)
 
-        # Commit updates
-        conn.commit()
+        in_flight = threading.BoundedSemaphore(workers * config.EMBEDDING_QUEUE_PER_WORKER)
+        stop = threading.Event()
+        updates = []
+        done = saved = 0
+        start = time.perf_counter()
+
+        results = pool.imap_unordered(encode_row, stream_rows(read_cursor, in_flight, stop))
+        for row_id, emp_id, blob, message in results:
+            in_flight.release()
+            done += 1
+
+            if blob is not None:
+                updates.append((blob, row_id))
+                saved += 1
+                print(f"Encoding saved for emp_id={emp_id} (row {row_id})")
+            else:
+                print(message)
+
+            # Periodic commits: a crash part-way keeps what was already encoded
+            if len(updates) >= WRITE_BATCH:
+                flush_updates(conn, updates)
+                updates = []
+
+            if done % REPORT_EVERY == 0:
+                rate = done / (time.perf_counter() - start)
+                print(f"[{done} rows] {rate:.1f} photos/s on {workers} workers")
+
+        if updates:
+            flush_updates(conn, updates)
+        read_cursor.close()
+
+        elapsed = time.perf_counter() - start
+        rate = done / elapsed if elapsed else 0.0
+        print(f"Total rows processed: {done}, encodings saved: {saved} "
+              f"({elapsed:.1f}s, {rate:.1f} photos/s on {workers} workers)")
         print("All encodings updated successfully.")
 
+        write_gallery_snapshot(conn)
+
     except Error as err:
         print(f"MySQL Error: {err}")
 
+    except OSError as err:
+        print(f"Snapshot Error: {err}")
+
     finally:
+        if 'stop' in locals():
+            stop.set()
+        pool.terminate()
+        if 'read_conn' in locals():
+            read_conn.close()
         if 'conn' in locals():
             conn.close()
             print("Database connection closed.")
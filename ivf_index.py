@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import config
+
+# Rows per block when assigning vectors to centroids (bounds the N x k temp matrix)
+ASSIGN_BLOCK = 8192
+
+
+def nearest_centroid(data, centroids):
+    c_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), ASSIGN_BLOCK):
+        block = data[start:start + ASSIGN_BLOCK]
+        # |x|^2 is the same for every centroid, so it can be left out of the argmin
+        d2 = c_norms - 2.0 * (block @ centroids.T)
+        labels[start:start + len(block)] = np.argmin(d2, axis=1)
+    return labels
+
+
+def kmeans(data, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        labels = nearest_centroid(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        order = np.argsort(labels, kind='stable')
+        filled = np.flatnonzero(counts)
+        starts = np.r_[0, np.cumsum(counts[filled])[:-1]]
+        centroids[filled] = np.add.reduceat(data[order], starts) / counts[filled, None]
+
+        # Re-seed empty clusters from random points
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file coarse quantizer for FaceGallery.
+
+    Gallery rows are bucketed by their nearest k-means centroid; a probe only
+    scans the nprobe nearest buckets. The gallery re-ranks those candidates
+    with exact distances, so thresholds and the confidence gap see true
+    distances - the index only decides who gets checked.
+    """
+
+    def __init__(self, nprobe=8, min_size=5000, train_sample=40):
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.train_sample = train_sample
+        self.centroids = None
+        self._c_norms = None
+        self.trained_size = 0
+        self.assign = np.empty(0, dtype=np.int32)
+        self._lists = None
+
+    def needs_training(self, n):
+        if n < self.min_size:
+            return False
+        return self.centroids is None or n > 2 * self.trained_size or n < self.trained_size // 2
+
+    def train(self, matrix):
+        n = len(matrix)
+        k = max(int(np.sqrt(n)), 1)
+        rng = np.random.default_rng(0)
+        sample_size = min(n, k * self.train_sample)
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+
+        self.centroids = kmeans(sample, k)
+        self._c_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.assign = np.empty(max(len(self.assign), n), dtype=np.int32)
+        self.assign[:n] = nearest_centroid(matrix, self.centroids)
+        self.trained_size = n
+        self._lists = None
+
+    def add(self, slot, vector):
+        if self.centroids is None:
+            return
+        if slot >= len(self.assign):
+            assign = np.empty(max(2 * len(self.assign), slot + 1), dtype=np.int32)
+            assign[:len(self.assign)] = self.assign
+            self.assign = assign
+        self.assign[slot] = nearest_centroid(vector[None, :], self.centroids)[0]
+        self._lists = None
+
+    def move(self, src, dst):
+        if self.centroids is None:
+            return
+        self.assign[dst] = self.assign[src]
+        self._lists = None
+
+    def _inverted_lists(self, matrix, sq_norms):
+        """
+        (order, bounds, vectors, norms): slots sorted by bucket, bucket c
+        spanning order[bounds[c]:bounds[c+1]], and the matching rows copied
+        bucket-contiguous so a probe never gathers scattered rows.
+        Rebuilt lazily after the gallery changes.
+        """
+        n = len(matrix)
+        if self._lists is None or len(self._lists[0]) != n:
+            assign = self.assign[:n]
+            order = np.argsort(assign, kind='stable')
+            bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds, np.ascontiguousarray(matrix[order]), sq_norms[order])
+        return self._lists
+
+    def search(self, probe, matrix, sq_norms):
+        """
+        Exact distances from probe to the rows in its nprobe nearest buckets:
+        (slots, distances), or None when the whole gallery should be scanned.
+        """
+        if self.centroids is None or len(matrix) < self.min_size:
+            return None
+
+        order, bounds, vectors, norms = self._inverted_lists(matrix, sq_norms)
+        coarse = self._c_norms - 2.0 * (self.centroids @ probe)
+        nprobe = min(self.nprobe, len(coarse))
+        nearest = np.sort(np.argpartition(coarse, nprobe - 1)[:nprobe])
+
+        spans = [(bounds[c], bounds[c + 1]) for c in nearest]
+        d2 = np.concatenate([vectors[lo:hi] @ probe for lo, hi in spans])
+        d2 *= -2.0
+        d2 += np.concatenate([norms[lo:hi] for lo, hi in spans])
+        d2 += probe @ probe
+        np.maximum(d2, 0.0, out=d2)
+        slots = np.concatenate([order[lo:hi] for lo, hi in spans])
+        return slots, np.sqrt(d2, out=d2)
+
+
+def index_from_config():
+    """The gallery index selected by config.GALLERY_INDEX (None = brute force)"""
+    if config.GALLERY_INDEX == "ivf":
+        return IVFIndex(nprobe=config.IVF_NPROBE, min_size=config.IVF_MIN_SIZE)
+    return None
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#!/home/pi/acs/acsenv/bin/python
+"""
+Schema migrations, applied in order at startup by the kiosks and sync
+scripts. Each step runs once per database; applied versions are kept in
+schema_migrations. Steps must be safe on databases that already have the
+objects (installs restored from schema.sql, or tables made by the old
+per-script CREATE TABLE IF NOT EXISTS copies). ALTER ... IF NOT EXISTS is
+MariaDB syntax, which is what the devices run. A step is an SQL string,
+or a function taking the cursor for data moves SQL alone cannot do.
+
+    python migrations.py             apply pending migrations
+    python migrations.py --explain   also EXPLAIN the hot queries and fail
+                                     if any of them does not use its index
+"""
+import sys
+from datetime import datetime, timedelta
+import config
+import queries
+from db import get_conn
+from gallery import decode_encoding, encoding_to_blob
+
+LOCK_NAME = "face_attendance_migrations"
+LOCK_TIMEOUT = 30
+
+def has_column(cursor, table, column):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def move_photos_and_encodings(cursor):
+    """
+    Photos go to the content-addressed photos table and base64 encodings
+    become fixed-width binary, then the bulky info columns are dropped.
+    Each part checks that its source column is still there, so a run that
+    died half-way can simply be repeated.
+    """
+    if has_column(cursor, "info", "image"):
+        # SHA2 of the utf8 text is the same digest sync_emp_data.image_hash computes
+        cursor.execute("""
+            UPDATE info SET image_hash = SHA2(image, 256)
+            WHERE image IS NOT NULL AND image_hash IS NULL
+        """)
+        cursor.execute("""
+            INSERT IGNORE INTO photos (image_hash, image, created_on)
+            SELECT image_hash, image, created_on FROM info WHERE image IS NOT NULL
+        """)
+
+    if has_column(cursor, "info", "encodings"):
+        cursor.execute("""
+            SELECT id, encodings FROM info
+            WHERE encodings IS NOT NULL AND encodings <> '' AND encoding IS NULL
+        """)
+        updates = []
+        for row_id, enc_b64 in cursor.fetchall():
+            try:
+                face_encoding = decode_encoding(enc_b64)
+            except Exception:
+                face_encoding = None
+            if face_encoding is not None:
+                updates.append((encoding_to_blob(face_encoding), row_id))
+        if updates:
+            cursor.executemany("UPDATE info SET encoding = %s WHERE id = %s", updates)
+
+    cursor.execute("ALTER TABLE info DROP COLUMN IF EXISTS image, DROP COLUMN IF EXISTS encodings")
+
+
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            emp_id INT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            status VARCHAR(50) DEFAULT NULL,
+            timestamp DATETIME DEFAULT NULL,
+            device_id INT DEFAULT NULL
+        )
+        """,
+        # Tables created by the old kiosk copies had no device_id
+        "ALTER TABLE attendance ADD COLUMN IF NOT EXISTS device_id INT DEFAULT NULL",
+        """
+        CREATE TABLE IF NOT EXISTS info (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            emp_id INT DEFAULT NULL,
+            empno VARCHAR(255) DEFAULT NULL,
+            name VARCHAR(255) DEFAULT NULL,
+            designation VARCHAR(255) DEFAULT NULL,
+            encodings LONGTEXT DEFAULT NULL,
+            image LONGTEXT DEFAULT NULL,
+            created_on DATETIME DEFAULT NULL,
+            updated_on DATETIME DEFAULT NULL,
+            UNIQUE KEY emp_id (emp_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_controller_db (
+            device_id INT PRIMARY KEY,
+            up_date_time VARCHAR(255) DEFAULT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_foreign_data (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            last_sync DATETIME NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_meta (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            last_synced VARCHAR(255) DEFAULT NULL
+        )
+        """,
+    ]),
+    (2, "attendance and info lookup indexes", [
+        # sync_foreign_data.py relies on this for INSERT IGNORE; IGNORE drops
+        # existing duplicates on tables that were created without it.
+        # (emp_id, timestamp) also serves the per-employee day lookup.
+        """
+        ALTER IGNORE TABLE attendance
+        ADD UNIQUE KEY IF NOT EXISTS uniq_attendance (emp_id, timestamp, status, device_id)
+        """,
+        # sync_attendance.py: this device's rows since the last upload
+        "ALTER TABLE attendance ADD INDEX IF NOT EXISTS idx_attendance_device_ts (device_id, timestamp)",
+        # Today's-status warm-up and the 7-day purge
+        "ALTER TABLE attendance ADD INDEX IF NOT EXISTS idx_attendance_ts (timestamp)",
+        # Gallery delta refresh
+        "ALTER TABLE info ADD INDEX IF NOT EXISTS idx_info_updated_on (updated_on)",
+    ]),
+    (3, "one info row per photo, with a content hash", [
+        # sync_emp_data.py stores one row per photo, so emp_id cannot be unique
+        "ALTER TABLE info DROP INDEX IF EXISTS emp_id",
+        "ALTER TABLE info ADD INDEX IF NOT EXISTS idx_info_emp_id (emp_id)",
+        "ALTER TABLE info ADD COLUMN IF NOT EXISTS image_hash CHAR(64) DEFAULT NULL",
+        "ALTER TABLE info ADD INDEX IF NOT EXISTS idx_info_image_hash (image_hash)",
+    ]),
+    (4, "content-addressed photo store, binary encodings", [
+        """
+        CREATE TABLE IF NOT EXISTS photos (
+            image_hash CHAR(64) PRIMARY KEY,
+            image LONGTEXT NOT NULL,
+            created_on DATETIME DEFAULT NULL
+        )
+        """,
+        # 128 little-endian float32 (gallery.encoding_to_blob)
+        "ALTER TABLE info ADD COLUMN IF NOT EXISTS encoding BINARY(512) DEFAULT NULL",
+        move_photos_and_encodings,
+    ]),
+    (5, "resumable employee sync", [
+        # hit_time of a sync_emp_data.py run that has not finished yet
+        "ALTER TABLE sync_meta ADD COLUMN IF NOT EXISTS resume_hit_time VARCHAR(255) DEFAULT NULL",
+        # Employees that run has already committed
+        """
+        CREATE TABLE IF NOT EXISTS sync_progress (
+            emp_id INT PRIMARY KEY
+        )
+        """,
+    ]),
+    (6, "re-encode photos aligned on the 68-point landmarks", [
+        # generate_embeddings.py now encodes with model="large", matching the
+        # kiosks' probes; clearing the old 5-point encodings makes it redo
+        # every photo once, and updated_on drops them from kiosk galleries
+        "UPDATE info SET encoding = NULL, updated_on = NOW() WHERE encoding IS NOT NULL",
+    ]),
+]
+
+
+def migrate():
+    """Apply pending migrations; returns the versions applied"""
+    conn = get_conn()
+    try:
+        cursor = conn.cursor()
+        # Kiosk and cron scripts may start together; only one of them migrates
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if not cursor.fetchone()[0]:
+            raise RuntimeError("Timed out waiting for the migration lock")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_on DATETIME NOT NULL
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in cursor.fetchall()}
+
+            applied = []
+            for version, name, statements in MIGRATIONS:
+                if version in done:
+                    continue
+                # DDL commits implicitly, so every statement must be re-runnable
+                for step in statements:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_on) VALUES (%s, %s, NOW())",
+                    (version, name)
+                )
+                conn.commit()
+                print(f"[DB INFO] Applied migration {version}: {name}")
+                applied.append(version)
+            return applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cursor.fetchall()
+            cursor.close()
+    finally:
+        conn.close()
+
+
+def explain_checks(cursor):
+    """
+    The hot queries, as the apps run them (see queries.py), with
+    representative parameters: (label, sql, params, {table: index the plan
+    should use}). Tables are named as EXPLAIN shows them (alias if any).
+    cursor is a dictionary cursor, used to pick realistic watermarks.
+    """
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM attendance")
+    watermark = cursor.fetchall()[0]["max_id"]
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    tomorrow = today + timedelta(days=1)
+    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+    return [
+        ("today's status warm-up", queries.STATUS_WARM_SQL, (today, tomorrow, watermark),
+         {"attendance": "idx_attendance_ts", "a": "PRIMARY"}),
+        ("status catch-up", queries.STATUS_CATCH_UP_SQL, (max(watermark - 100, 0),),
+         {"attendance": "PRIMARY"}),
+        ("attendance upload", queries.ATTENDANCE_UPLOAD_SQL, (week_ago, config.DEVICE_ID),
+         {"attendance": "idx_attendance_device_ts"}),
+        ("attendance purge", queries.ATTENDANCE_PURGE_SQL, (week_ago,),
+         {"attendance": "idx_attendance_ts"}),
+        ("gallery delta refresh", queries.GALLERY_DELTA_SQL, (today,),
+         {"info": "idx_info_updated_on"}),
+    ]
+
+
+def explain_plan(cursor, sql, params):
+    """EXPLAIN rows for the base tables sql reads (cursor must be a dictionary cursor)"""
+    cursor.execute("EXPLAIN " + sql, params)
+    # Skip derived / union results
+    return [row for row in cursor.fetchall() if not (row["table"] or "").startswith("<")]
+
+
+def plan_failures(label, plan, expected_keys):
+    """Messages for every table whose plan does not use the expected index"""
+    failures = []
+    if not plan:
+        failures.append(f"{label}: no plan rows")
+    for row in plan:
+        expected = expected_keys.get(row["table"])
+        if row["key"] != expected:
+            failures.append(f"{label}: {row['table']} uses {row['key']} (type={row['type']}, "
+                            f"possible_keys={row['possible_keys']}), expected {expected}")
+    return failures
+
+
+def explain():
+    """
+    EXPLAIN each hot query. A query fails the check when the index the
+    optimizer picks (key) is not the one it was written for. On a nearly
+    empty database the optimizer may prefer a full scan, so run this
+    against one holding real attendance (test_migrations.py seeds one).
+    """
+    conn = get_conn()
+    failures = 0
+    try:
+        cursor = conn.cursor(dictionary=True)
+        for label, sql, params, expected_keys in explain_checks(cursor):
+            plan = explain_plan(cursor, sql, params)
+            for row in plan:
+                print(f"{label}: {row['table']} type={row['type']} key={row['key']} "
+                      f"(want {expected_keys.get(row['table'])}) "
+                      f"possible_keys={row['possible_keys']} rows={row['rows']}")
+            for message in plan_failures(label, plan, expected_keys):
+                print("FAIL " + message)
+                failures += 1
+        cursor.close()
+    finally:
+        conn.close()
+    return failures
+
+
+def main():
+    applied = migrate()
+    if not applied:
+        print("[DB INFO] Schema is up to date.")
+    if "--explain" in sys.argv[1:] and explain():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
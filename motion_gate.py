@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import time
+import cv2
+import numpy as np
+
+# Frames are compared at this size: enough to see a person walk in,
+# small enough that the check costs next to nothing
+TINY_SIZE = (32, 24)
+
+
+class MotionGate:
+    """
+    Cheap "is anything moving?" check used to idle the detector.
+
+    Each frame is shrunk to TINY_SIZE and compared with the previous one.
+    Motion is when more than min_fraction of the pixels changed by more
+    than pixel_delta. update() stays True for hold_seconds after the last
+    motion, so someone who stops in front of the camera is still detected,
+    and it turns True on the very frame motion first shows up.
+    """
+
+    def __init__(self, pixel_delta=15, min_fraction=0.01, hold_seconds=3.0):
+        self.pixel_delta = pixel_delta
+        self.min_fraction = min_fraction
+        self.hold_seconds = hold_seconds
+        self._prev = None
+        self._last_motion = None
+
+    def update(self, gray):
+        tiny = cv2.resize(gray, TINY_SIZE, interpolation=cv2.INTER_AREA)
+        prev, self._prev = self._prev, tiny
+        now = time.monotonic()
+        if prev is None:
+            self._last_motion = now
+            return True
+
+        changed = np.count_nonzero(cv2.absdiff(tiny, prev) > self.pixel_delta)
+        if changed > self.min_fraction * tiny.size:
+            self._last_motion = now
+        return now - self._last_motion < self.hold_seconds
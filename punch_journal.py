@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+from db import get_conn
+
+FLUSH_BATCH = 500
+
+INSERT_SQL = """
+    INSERT IGNORE INTO attendance (emp_id, name, status, timestamp, device_id)
+    VALUES (%s, %s, %s, %s, %s)
+"""
+
+
+class PunchJournal:
+    """
+    Write-behind queue for punches.
+
+    append() commits the punch to a local SQLite file (WAL, fsync on every
+    commit) and returns, so a punch is acknowledged whatever state MariaDB
+    is in. A flusher thread batch-inserts journalled punches into
+    attendance and only then drops them from the journal. A crash between
+    the two replays the batch; uniq_attendance (emp_id, timestamp, status,
+    device_id) turns the replay into a no-op through INSERT IGNORE.
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS punches (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                emp_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                device_id INTEGER
+            )
+        """)
+        self._db.commit()
+
+    def append(self, emp_id, name, status, timestamp, device_id):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO punches (emp_id, name, status, timestamp, device_id) VALUES (?, ?, ?, ?, ?)",
+                (emp_id, name, status, timestamp, device_id)
+            )
+            self._db.commit()
+        self._wake.set()
+
+    def unflushed(self):
+        """(emp_id, status, timestamp) of journalled punches, oldest first"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT emp_id, status, timestamp FROM punches ORDER BY seq"
+            ).fetchall()
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM punches").fetchone()[0]
+
+    def flush(self):
+        """Move up to FLUSH_BATCH punches into MariaDB; returns how many"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, emp_id, name, status, timestamp, device_id FROM punches ORDER BY seq LIMIT ?",
+                (FLUSH_BATCH,)
+            ).fetchall()
+        if not rows:
+            return 0
+
+        conn = get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(INSERT_SQL, [row[1:] for row in rows])
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._db.execute("DELETE FROM punches WHERE seq <= ?", (rows[-1][0],))
+            self._db.commit()
+        return len(rows)
+
+    def _run(self):
+        while True:
+            # Woken right after a punch; the timeout retries after DB errors
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                while self.flush() == FLUSH_BATCH:
+                    pass
+            except Exception as e:
+                print(f"[ERROR] Punch flush failed, {self.pending()} waiting: {e}")
+
+    def start(self):
+        if self._thread is None:
+            # Punches left over from the last run go out straight away
+            self._wake.set()
+            self._thread = threading.Thread(target=self._run, name="punch-flusher", daemon=True)
+            self._thread.start()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+SQL for the hot paths, shared by the modules that run it and by the
+EXPLAIN check in migrations.py (explain_checks), so the plans checked are
+the plans production gets.
+"""
+
+# status_cache.TodayStatus.warm: (day start, day end, attendance.id watermark)
+STATUS_WARM_SQL = """
+    SELECT a.id, a.emp_id, a.status
+    FROM attendance a
+    JOIN (
+        SELECT emp_id, MAX(id) AS id
+        FROM attendance
+        WHERE timestamp >= %s AND timestamp < %s AND id <= %s
+        GROUP BY emp_id
+    ) latest ON latest.id = a.id
+"""
+
+# status_cache.TodayStatus.catch_up: (attendance.id watermark,)
+STATUS_CATCH_UP_SQL = """
+    SELECT id, emp_id, status, timestamp
+    FROM attendance
+    WHERE id > %s
+    ORDER BY id
+"""
+
+# sync_attendance.py: (last uploaded timestamp, device_id)
+ATTENDANCE_UPLOAD_SQL = """
+    SELECT emp_id, name, status, timestamp
+    FROM attendance
+    WHERE timestamp > %s and device_id = %s
+    ORDER BY timestamp ASC
+"""
+
+# sync_attendance.py: (cutoff timestamp,)
+ATTENDANCE_PURGE_SQL = """
+    DELETE FROM attendance
+    WHERE timestamp < %s
+"""
+
+# gallery.GallerySync: compact info rows only, photos live in the photos table
+GALLERY_ROWS_SQL = "SELECT id, emp_id, name, designation, encoding, updated_on FROM info"
+
+# gallery.GallerySync.refresh: (watermark - overlap,)
+GALLERY_DELTA_SQL = GALLERY_ROWS_SQL + " WHERE updated_on >= %s"
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from datetime import date, datetime, timedelta
+import db
+from queries import STATUS_CATCH_UP_SQL, STATUS_WARM_SQL
+
+
+def day_bounds(day):
+    """[start, end) of a calendar day, for index-friendly timestamp ranges"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+class TodayStatus:
+    """
+    emp_id -> status of today's latest punch, kept in memory so the punch
+    button can be chosen without a database round-trip.
+
+    Warmed with one grouped query, then kept current from rows with an
+    attendance.id above the last one seen (local punches, other devices'
+    rows imported by sync_foreign_data.py). "Latest" is the highest id,
+    as in the per-employee lookup this replaces. Emptied at midnight.
+
+    With a journal (punch_journal.PunchJournal), punches still waiting in
+    it are applied on top of every warm-up, so a restart while the
+    database is unreachable does not forget them.
+    """
+
+    def __init__(self, journal=None):
+        self._lock = threading.Lock()
+        self._day = None
+        self._last = {}         # emp_id -> (attendance id, status)
+        self._watermark = None  # highest attendance.id applied
+        self.journal = journal
+        with self._lock:
+            self._roll_day()
+            self._replay_journal()
+
+    def warm(self):
+        max_row = db.fetchone("SELECT COALESCE(MAX(id), 0) FROM attendance")
+        watermark = max_row[0]
+        day = date.today()
+        start, end = day_bounds(day)
+        rows = db.fetchall(STATUS_WARM_SQL, (start, end, watermark))
+
+        with self._lock:
+            self._day = day
+            self._last = {emp_id: (row_id, status) for row_id, emp_id, status in rows}
+            self._watermark = watermark
+            self._replay_journal()
+        return len(rows)
+
+    def _roll_day(self):
+        # Caller holds the lock. Nobody has punched yet on a new day.
+        today = date.today()
+        if self._day != today:
+            self._day = today
+            self._last = {}
+
+    def _replay_journal(self):
+        # Caller holds the lock. Journalled punches are not in attendance yet.
+        if self.journal is None:
+            return
+        start, end = day_bounds(self._day)
+        for emp_id, status, timestamp in self.journal.unflushed():
+            if start <= datetime.fromisoformat(timestamp) < end:
+                self._record_local(emp_id, status)
+
+    def _record_local(self, emp_id, status):
+        # Caller holds the lock. A punch made here is the employee's newest,
+        # whatever placeholder an earlier local punch got; it ranks after
+        # every row seen so far, so its own row replaces it on catch-up.
+        row_id = (self._watermark or 0) + 0.5
+        current = self._last.get(emp_id)
+        if current is not None:
+            row_id = max(row_id, current[0])
+        self._last[emp_id] = (row_id, status)
+
+    def _apply(self, row_id, emp_id, status):
+        current = self._last.get(emp_id)
+        if current is None or row_id > current[0]:
+            self._last[emp_id] = (row_id, status)
+
+    def catch_up(self):
+        """Apply attendance rows inserted since the last warm/catch-up"""
+        if self._watermark is None:
+            return self.warm()
+
+        rows = db.fetchall(STATUS_CATCH_UP_SQL, (self._watermark,))
+
+        with self._lock:
+            self._roll_day()
+            start, end = day_bounds(self._day)
+            for row_id, emp_id, status, timestamp in rows:
+                if start <= timestamp < end:
+                    self._apply(row_id, emp_id, status)
+                self._watermark = max(self._watermark, row_id)
+        return len(rows)
+
+    def status(self, emp_id):
+        """Today's last status ("in"/"out") for emp_id, or None if no punch yet"""
+        if self._watermark is None:
+            try:
+                self.warm()
+            except Exception as e:
+                # Database unreachable: answer from journalled punches alone
+                print(f"[ERROR] Attendance status warm-up failed: {e}")
+        with self._lock:
+            self._roll_day()
+            current = self._last.get(emp_id)
+        return current[1] if current else None
+
+    def record(self, emp_id, status, row_id=None):
+        """
+        A punch this process just made. Without a row_id (journalled, not in
+        the database yet) it replaces the employee's current status, and its
+        own row replaces it once the catch-up reaches it.
+        """
+        with self._lock:
+            self._roll_day()
+            if row_id is None:
+                self._record_local(emp_id, status)
+            else:
+                self._apply(row_id, emp_id, status)
+
+    def run_catch_up(self, interval):
+        """Catch-up loop for a daemon thread"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.catch_up()
+            except Exception as e:
+                print(f"[ERROR] Attendance status catch-up failed: {e}")
@@ -1,16 +1,16 @@
 #!/home/pi/acs/acsenv/bin/python
-import mysql.connector
 from mysql.connector import Error
 import json
 import requests
 from datetime import datetime, timedelta
 import config
+from db import get_conn
+from migrations import migrate
+from queries import ATTENDANCE_PURGE_SQL, ATTENDANCE_UPLOAD_SQL
 
 api_url = "http://admin.jhc.vms/api/sync-attendance-log"
 
 
-def get_conn():
-    return mysql.connector.connect(**config.DB_CONFIG)
 
 
 current_time = datetime.now()
@@ -19,13 +19,6 @@ current_formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
 
 
 def ensure_sync_table(cursor, conn):
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sync_controller_db (
-            device_id INT PRIMARY KEY,
-            up_date_time DATETIME
-        )
-    """)
-
     cursor.execute("SELECT COUNT(*) FROM sync_controller_db WHERE device_id = 1")
     count = cursor.fetchone()[0]
 
@@ -39,6 +32,7 @@ def ensure_sync_table(cursor, conn):
 
 def main():
     try:
+        migrate()
         conn = get_conn()
         cursor = conn.cursor()
 
@@ -50,18 +44,12 @@ def main():
 
         print(f"Last synced at: {last_synced}")
 
-        cursor.execute("""
-            SELECT emp_id, name, status, timestamp
-            FROM attendance
-            WHERE timestamp > %s and device_id = %s
-            ORDER BY timestamp ASC
-        """, (last_synced,config.DEVICE_ID))
+        cursor.execute(ATTENDANCE_UPLOAD_SQL, (last_synced,config.DEVICE_ID))
 
         records = cursor.fetchall()
 
         if not records:
             print("No new attendance records to sync.")
-            conn.close()
             return
 
         data_list = []
@@ -87,10 +75,7 @@ def main():
                     WHERE device_id = 1
                 """, (last_record_time,))
 
-                cursor.execute("""
-                    DELETE FROM attendance
-                    WHERE timestamp < %s
-                """, (cutoff_timestamp,))
+                cursor.execute(ATTENDANCE_PURGE_SQL, (cutoff_timestamp,))
 
                 conn.commit()
 
@@ -1,111 +1,263 @@
 # -*- coding: utf-8 -*-
 #!/home/pi/acs/acsenv/bin/python
 
+import hashlib
 import requests
 import json
-import mysql.connector
 import traceback
 from datetime import datetime
 import config
+from db import get_conn
+from migrations import migrate
 
-def get_connection():
-    return mysql.connector.connect(**config.DB_CONFIG)
+try:
+    from ijson import parse as ijson_parse
+    from ijson.common import ObjectBuilder
+except ImportError:
+    # Without ijson the whole payload is loaded with response.json()
+    ijson_parse = None
 
-def get_last_synced(cursor):
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sync_meta (
-            id INT PRIMARY KEY,
-            last_synced VARCHAR(255)
-        )
-    """)
-    cursor.execute("SELECT last_synced FROM sync_meta WHERE id = 1")
+# The API sends a photo in 'image' and up to nine more in 'img1'..'img9'
+IMAGE_KEYS = ['image'] + [f'img{i}' for i in range(1, 10)]
+
+
+def image_hash(image):
+    """Content hash of a photo exactly as stored in photos.image"""
+    return hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+
+def get_sync_state(cursor):
+    """(last_synced, hit_time of an unfinished run or None)"""
+    cursor.execute("SELECT last_synced, resume_hit_time FROM sync_meta WHERE id = 1")
     row = cursor.fetchone()
-    if row and row[0]:
-        return row[0]
-    else:
-        return "1970-01-01 00:00:00"
+    if not row:
+        return "1970-01-01 00:00:00", None
+    return row[0] or "1970-01-01 00:00:00", row[1]
 
-def update_last_synced(cursor, timestamp):
+def start_run(cursor, hit_time):
+    cursor.execute("DELETE FROM sync_progress")
     cursor.execute("""
-        INSERT INTO sync_meta (id, last_synced)
+        INSERT INTO sync_meta (id, resume_hit_time)
         VALUES (1, %s)
-        ON DUPLICATE KEY UPDATE last_synced = VALUES(last_synced)
+        ON DUPLICATE KEY UPDATE resume_hit_time = VALUES(resume_hit_time)
+    """, (hit_time,))
+
+def finish_run(cursor, timestamp):
+    cursor.execute("""
+        INSERT INTO sync_meta (id, last_synced, resume_hit_time)
+        VALUES (1, %s, NULL)
+        ON DUPLICATE KEY UPDATE last_synced = VALUES(last_synced), resume_hit_time = NULL
     """, (timestamp,))
+    cursor.execute("DELETE FROM sync_progress")
+
+
+def iter_payload(response):
+    """
+    Yields ("to_add" | "to_delete", item) from the API response. With
+    ijson the body is parsed as it arrives and only one employee (with
+    their photos) is held at a time.
+    """
+    if ijson_parse is None:
+        data = response.json()
+        for section in ("to_add", "to_delete"):
+            for item in data.get(section) or []:
+                yield section, item
+        return
+
+    item_prefixes = ("to_add.item", "to_delete.item")
+    response.raw.decode_content = True  # undo gzip/deflate transfer encoding
+    builder = None
+    for prefix, event, value in ijson_parse(response.raw):
+        if builder is None:
+            if prefix in item_prefixes and event == "start_map":
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            continue
+        builder.event(event, value)
+        if prefix in item_prefixes and event == "end_map":
+            yield prefix.split(".")[0], builder.value
+            builder = None
+
+
+def user_row(item):
+    """(emp_id, empno, name, designation, photos) or None if no usable photo"""
+    # Check if image data exists and is not just an empty string
+    valid_images = [str(item[key]) for key in IMAGE_KEYS if item.get(key) and len(str(item[key])) > 50]
+    if not valid_images:
+        return None
+    return (item.get("empid"), item.get("empno"), item.get("employee_name"),
+            item.get("designation"), valid_images)
+
+
+def write_chunk(cursor, users):
+    """
+    Replace the info rows of a chunk of employees, storing photos we do
+    not have yet. Returns (info rows inserted, new photos stored).
+    """
+    digests = {}
+    for *_, images in users:
+        for image in images:
+            digests.setdefault(image_hash(image), image)
+    if not digests:
+        return 0, 0
+
+    # Photos are stored once per content hash. Images we already have are
+    # not written again, and their encodings carry over so
+    # generate_embeddings.py skips them.
+    placeholders = ", ".join(["%s"] * len(digests))
+    cursor.execute(f"SELECT image_hash FROM photos WHERE image_hash IN ({placeholders})", list(digests))
+    stored = {row[0] for row in cursor.fetchall()}
+    cursor.execute(f"""
+        SELECT image_hash, encoding FROM info
+        WHERE image_hash IN ({placeholders}) AND encoding IS NOT NULL
+    """, list(digests))
+    known = dict(cursor.fetchall())
+
+    new_photos = [(digest, image) for digest, image in digests.items() if digest not in stored]
+    info_rows = [
+        (emp_id, empno, name, designation, digest, known.get(digest))
+        for emp_id, empno, name, designation, images in users
+        for digest in (image_hash(image) for image in images)
+    ]
+
+    # Wipe the slate clean for these IDs so we don't have duplicates
+    cursor.executemany("DELETE FROM info WHERE emp_id = %s", [(user[0],) for user in users])
+    if new_photos:
+        cursor.executemany("""
+            INSERT IGNORE INTO photos (image_hash, image, created_on)
+            VALUES (%s, %s, NOW())
+        """, new_photos)
+    cursor.executemany("""
+        INSERT INTO info (emp_id, empno, name, designation, image_hash, created_on, updated_on, encoding)
+        VALUES (%s, %s, %s, %s, %s, NOW(), NOW(), %s)
+    """, info_rows)
+    return len(info_rows), len(new_photos)
+
+
+def commit_users(conn, cursor, users):
+    """
+    Write users and record them in sync_progress, committing once. If the
+    chunk fails it is rolled back and retried one employee at a time, so a
+    bad row only costs that employee (logged and skipped)
+    and not the whole sync. Returns (users written, info rows, new photos).
+    """
+    def commit(batch):
+        inserted, stored = write_chunk(cursor, batch)
+        cursor.executemany("INSERT IGNORE INTO sync_progress (emp_id) VALUES (%s)",
+                           [(user[0],) for user in batch])
+        conn.commit()
+        return inserted, stored
+
+    try:
+        return (len(users),) + commit(users)
+    except Exception as e:
+        conn.rollback()
+        if len(users) == 1:
+            print(f"Skipping user {users[0][2] or 'Unknown'}: {e}")
+            return 0, 0, 0
+        print(f"Chunk of {len(users)} users failed ({e}), retrying one at a time")
+
+    written = total_inserted = total_stored = 0
+    for user in users:
+        try:
+            inserted, stored = commit([user])
+        except Exception as e:
+            conn.rollback()
+            print(f"Skipping user {user[2] or 'Unknown'}: {e}")
+            continue
+        written += 1
+        total_inserted += inserted
+        total_stored += stored
+    return written, total_inserted, total_stored
+
 
 def main():
     conn = None
     try:
-        conn = get_connection()
+        migrate()
+        conn = get_conn()
         cursor = conn.cursor()
 
-        # 1. Get last synced time
-        last_synced = get_last_synced(cursor)
+        # 1. Get last synced time, and whether the previous run finished
+        last_synced, resume_hit_time = get_sync_state(cursor)
         print(f"Last synced: {last_synced}")
 
-        # 2. Current API hit time
-        hit_time = datetime.now().replace(second=0, microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
-        print(f"API hit time: {hit_time}")
+        # 2. Current API hit time. A run that died part-way is resumed with
+        # its own hit_time: employees changed since then are fetched again
+        # by the next sync, so skipping the ones it committed loses nothing.
+        done = set()
+        if resume_hit_time:
+            hit_time = resume_hit_time
+            cursor.execute("SELECT emp_id FROM sync_progress")
+            done = {str(row[0]) for row in cursor.fetchall()}
+            print(f"Resuming sync of {hit_time}, {len(done)} employee(s) already written")
+        else:
+            hit_time = datetime.now().replace(second=0, microsecond=0).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"API hit time: {hit_time}")
 
         # 3. Build API URL
         api_url = f"http://admin.jhc.vms/api/sync-employees-for-attendance/75/{last_synced}"
         print(f"Hitting API: {api_url}")
 
-        response = requests.get(api_url, verify=False, timeout=15)
-        if response.status_code != 200:
-            print(f"API failed with status {response.status_code}")
-            return
+        response = requests.get(api_url, verify=False, timeout=15, stream=True)
+        with response:
+            if response.status_code != 200:
+                print(f"API failed with status {response.status_code}")
+                return
 
-        data = response.json()
-        print("Sync started...")
+            if not resume_hit_time:
+                start_run(cursor, hit_time)
+                conn.commit()
+            print("Sync started...")
 
-        # ======================================================
-        # INSERT / UPDATE LOGIC (Variable Images 1-10)
-        # ======================================================
-        users_processed = 0
-        total_photos_inserted = 0
-
-        # Define all possible keys the API might send
-        # It checks 'image', then 'img1' through 'img9'
-        possible_keys = ['image'] + [f'img{i}' for i in range(1, 10)]
-
-        for item in data.get("to_add", []):
-            try:
-                emp_id = item.get("empid")
-                empno = item.get("empno")
-                name = item.get("employee_name")
-                designation = item.get("designation")
-
-                # Step A: Collect all valid images for this specific user
-                valid_images = []
-                for key in possible_keys:
-                    img_data = item.get(key)
-                    # Check if image data exists and is not just an empty string
-                    if img_data and len(str(img_data)) > 50:
-                        valid_images.append(img_data)
+            # ======================================================
+            # INSERT / UPDATE LOGIC (Variable Images 1-10), per chunk
+            # ======================================================
+            users_processed = 0
+            skipped = 0
+            total_photos_inserted = 0
+            new_photos = 0
+            to_delete = []
+            chunk = {}
 
+            def commit_chunk():
+                nonlocal users_processed, total_photos_inserted, new_photos
+                written, inserted, stored = commit_users(conn, cursor, list(chunk.values()))
+                users_processed += written
+                total_photos_inserted += inserted
+                new_photos += stored
+                chunk.clear()
+
+            for section, item in iter_payload(response):
+                if section == "to_delete":
+                    if item.get("emp_id"):
+                        to_delete.append(item["emp_id"])
+                    continue
+                try:
+                    user = user_row(item)
+                except Exception as e:
+                    print(f"Skipping user {item.get('employee_name', 'Unknown')}: {e}")
+                    continue
                 # If no images found at all, skip this user
-                if not valid_images:
+                if user is None:
+                    continue
+                if str(user[0]) in done:
+                    skipped += 1
                     continue
 
-                # Step B: DELETE existing rows for this user
-                # We wipe the slate clean for this ID so we don't have duplicates
-                cursor.execute("DELETE FROM info WHERE emp_id = %s", (emp_id,))
-
-                # Step C: INSERT a new row for EACH image found
-                for img_blob in valid_images:
-                    cursor.execute("""
-                        INSERT INTO info (emp_id, empno, name, designation, image, created_on, encodings)
-                        VALUES (%s, %s, %s, %s, %s, NOW(), NULL)
-                    """, (emp_id, empno, name, designation, img_blob))
-                    total_photos_inserted += 1
-                
-                users_processed += 1
+                # A later entry for the same employee replaces the earlier one
+                chunk[user[0]] = user
+                if len(chunk) >= config.SYNC_CHUNK_SIZE:
+                    commit_chunk()
 
-            except Exception as e:
-                print(f"Skipping user {item.get('employee_name', 'Unknown')}: {e}")
+            if chunk:
+                commit_chunk()
 
+        if skipped:
+            print(f"{skipped} user(s) already written by the interrupted run.")
         if users_processed > 0:
-            print(f"Processed {users_processed} users. Total {total_photos_inserted} photos inserted.")
+            print(f"Processed {users_processed} users. Total {total_photos_inserted} photos inserted "
+                  f"({new_photos} new images stored).")
         else:
             print("No new/updated records found.")
 
@@ -113,16 +265,22 @@ def main():
         # DELETE LOGIC
         # ======================================================
         deleted_count = 0
-        for item in data.get("to_delete", []):
-            emp_id = item.get("emp_id")
-            if emp_id:
-                cursor.execute("DELETE FROM info WHERE emp_id = %s", (emp_id,))
-                deleted_count += cursor.rowcount
+        for emp_id in to_delete:
+            cursor.execute("DELETE FROM info WHERE emp_id = %s", (emp_id,))
+            deleted_count += cursor.rowcount
 
         print(f"{deleted_count} record(s) deleted.")
 
-        # Save last sync time
-        update_last_synced(cursor, hit_time)
+        # Drop stored images no info row points at any more
+        cursor.execute("""
+            DELETE p FROM photos p
+            LEFT JOIN info i ON i.image_hash = p.image_hash
+            WHERE i.id IS NULL
+        """)
+        print(f"{cursor.rowcount} unused photo(s) removed.")
+
+        # Save last sync time; the run is complete
+        finish_run(cursor, hit_time)
 
         conn.commit()
         print(f"Sync completed successfully at {hit_time}")
@@ -138,4 +296,4 @@ def main():
             print("DB connection closed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,7 @@
 import requests
-import mysql.connector
 from datetime import datetime
 import config
+from db import get_conn
 
 BASE_API_URL = "http://admin.jhc.vms/api/sync-all-controller-attendance"
 
@@ -38,12 +38,7 @@ def insert_attendance(record, cursor):
 def main():
     try:
         # DB connect
-        db = mysql.connector.connect(
-            host="localhost",
-            user="acs_user",
-            password="Secret4acs_user",
-            database="face_attendance"
-        )
+        db = get_conn()
         cursor = db.cursor()
 
         # 1) Get last sync time
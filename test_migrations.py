@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the hot queries (migrations.explain_checks) use their indexes.
+
+Needs a scratch MariaDB database the configured user may write to; its
+attendance and info tables are emptied and refilled. Skipped otherwise:
+
+    FACE_ATTENDANCE_TEST_DB=face_attendance_test python -m pytest test_migrations.py
+"""
+import os
+from datetime import datetime, timedelta
+import pytest
+
+TEST_DB = os.environ.get("FACE_ATTENDANCE_TEST_DB")
+
+pytestmark = pytest.mark.skipif(not TEST_DB, reason="FACE_ATTENDANCE_TEST_DB is not set")
+
+EMPLOYEES = 250
+DEVICES = list(range(61, 71))  # other kiosks; config.DEVICE_ID is added
+DAYS_KEPT = 8  # sync_attendance.py purges after 7 days
+
+
+def seed(cursor, device_id):
+    """A week of punches from several devices and a year of info updates"""
+    devices = DEVICES + [device_id]
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    punches = []
+    for day in range(DAYS_KEPT):
+        start = today - timedelta(days=day)
+        for emp_id in range(1, EMPLOYEES + 1):
+            device = devices[emp_id % len(devices)]
+            punches.append((emp_id, f"emp {emp_id}", "in", start + timedelta(hours=9), device))
+            punches.append((emp_id, f"emp {emp_id}", "out", start + timedelta(hours=17), device))
+    cursor.execute("DELETE FROM attendance")
+    cursor.executemany("""
+        INSERT INTO attendance (emp_id, name, status, timestamp, device_id)
+        VALUES (%s, %s, %s, %s, %s)
+    """, punches)
+
+    photos = [
+        (emp_id, f"emp {emp_id}", today - timedelta(days=(emp_id * 7 + n) % 365))
+        for emp_id in range(1, EMPLOYEES + 1) for n in range(4)
+    ]
+    cursor.execute("DELETE FROM info")
+    cursor.executemany("""
+        INSERT INTO info (emp_id, name, created_on, updated_on)
+        VALUES (%s, %s, %s, %s)
+    """, [(emp_id, name, updated_on, updated_on) for emp_id, name, updated_on in photos])
+
+    # Fresh statistics, as a long-running database would have
+    cursor.execute("ANALYZE TABLE attendance, info")
+    cursor.fetchall()
+
+
+@pytest.fixture(scope="module")
+def cursor():
+    pytest.importorskip("mysql.connector")
+    import config
+    import db
+    from migrations import migrate
+
+    saved_config, saved_pool = config.DB_CONFIG, db._pool
+    config.DB_CONFIG = dict(config.DB_CONFIG, database=TEST_DB)
+    db._pool = None
+    conn = None
+    try:
+        migrate()
+        conn = db.get_conn()
+        cursor = conn.cursor(dictionary=True)
+        seed(cursor, config.DEVICE_ID)
+        conn.commit()
+        yield cursor
+        cursor.close()
+    finally:
+        if conn is not None:
+            conn.close()
+        config.DB_CONFIG, db._pool = saved_config, saved_pool
+
+
+def test_hot_queries_use_their_indexes(cursor):
+    from migrations import explain_checks, explain_plan, plan_failures
+    failures = []
+    for label, sql, params, expected_keys in explain_checks(cursor):
+        failures += plan_failures(label, explain_plan(cursor, sql, params), expected_keys)
+    assert not failures, "\n".join(failures)